@@ -95,6 +95,7 @@ export default function columnsToColDefs(
 
   if (view == 'gamesettings' || view == 'recent_games') {
     _.set(columnDefs['index'], 'hide', true)
+    _.set(columnDefs['setting_fingerprint'], 'hide', true)
     _.set(columnDefs['AI'], 'width', 93)
     _.set(columnDefs['Result'], 'width', 100)
     _.set(columnDefs['Map'], 'width', 170)
@@ -1,4 +1,8 @@
-import { parquetMetadata, parquetRead } from 'hyparquet'
+import {
+  asyncBufferFromUrl,
+  parquetMetadataAsync,
+  parquetRead,
+} from 'hyparquet'
 import { compressors } from 'hyparquet-compressors'
 import columnsToColDefs from './columnDefs'
 import { FetchParams } from './types'
@@ -22,55 +26,120 @@ const Capitalize = (str: string) => {
   return str.charAt(0).toUpperCase() + str.slice(1)
 }
 
+// bumped by every fetch, a fetch of a view left since drops its rows
+let generation = 0
+// recent games pages not loaded yet, oldest last
+let olderPages: string[] = []
+let loadingOlderPage = false
+
+const readFile = async (
+  key: string,
+  view: FetchParams['view'],
+  filter: FetchParams['filter'],
+): Promise<{ rows: any[]; columns: { [key: string]: string }[] }> => {
+  const file = await asyncBufferFromUrl(
+    JoinUrlParts(import.meta.env.VITE_FILE_SERVE_HOST, key),
+  )
+  const metadata = await parquetMetadataAsync(file)
+
+  // difficulty tiers are row group aligned, only the selected one is read
+  let rowStart: number | undefined, rowEnd: number | undefined
+  const tiers = metadata.key_value_metadata?.find(
+    (keyValue) => keyValue.key === 'tiers',
+  )
+  if (view === 'gamesettings' && tiers?.value) {
+    const tier = filter.toString().replace('easy', 'cheese')
+    ;[rowStart, rowEnd] = JSON.parse(tiers.value)[tier] ?? []
+  }
+
+  let rows: any[] = []
+  let columns: { [key: string]: string }[] = []
+  await parquetRead({
+    file,
+    metadata,
+    rowStart,
+    rowEnd,
+    compressors,
+    onComplete: (parquetData: any) => {
+      const schema = metadata.schema
+
+      columns = schema.reduce(
+        (acc: { [key: string]: string }[], column, index) => {
+          ;(schema[index].type !== undefined ||
+            column.name == 'Top-5 Difficulties' ||
+            column.name.includes('Replays')) &&
+            schema[index]?.name !== 'element' &&
+            acc.push({
+              name: column.name,
+              type: column.type === 'BYTE_ARRAY' ? 'string' : 'number',
+            })
+          return acc
+        },
+        [],
+      )
+
+      rows = parquetData.map((row: any) =>
+        row.reduce((acc: any, value: any, index: number) => {
+          if (columns[index]) acc[columns[index].name] = value
+          return acc
+        }, {}),
+      )
+    },
+  })
+  return { rows, columns }
+}
+
 export const fetchData = async (params: FetchParams) => {
   const { view, ai, filter, rowData = {}, colDefs = {} } = params
+  const fetchGeneration = ++generation
+  olderPages = []
   let _file = 'gamesetting_games.parquet'
   if (view === 'gamesettings') {
-    _file = `${Capitalize(ai.toString())}.${filter
-      .toString()
-      .replace('easy', 'cheese')}.grouped_gamesettings.parquet`
+    _file = `${Capitalize(ai.toString())}.grouped_gamesettings.parquet`
   } else if (view === 'ratings') {
     _file = `PveRating.${Capitalize(ai.toString())}_gamesettings.parquet`
   }
 
   try {
-    const response = await fetch(
-      JoinUrlParts(import.meta.env.VITE_FILE_SERVE_HOST, _file),
+    // hashed file names never change content, only the manifest is revalidated
+    const manifest = await fetch(
+      JoinUrlParts(import.meta.env.VITE_FILE_SERVE_HOST, 'manifest.json'),
+      { cache: 'no-cache' },
     )
+      .then((response) => (response.ok ? response.json() : {}))
+      .catch(() => ({}))
 
-    const arrayBuffer = await response.arrayBuffer()
-    await parquetRead({
-      file: arrayBuffer,
-      compressors,
-      onComplete: (parquetData: any) => {
-        const schema = parquetMetadata(arrayBuffer).schema
-
-        const columns = schema.reduce(
-          (acc: { [key: string]: string }[], column, index) => {
-            ;(schema[index].type !== undefined ||
-              column.name == 'Top-5 Difficulties' ||
-              column.name.includes('Replays')) &&
-              schema[index]?.name !== 'element' &&
-              acc.push({
-                name: column.name,
-                type: column.type === 'BYTE_ARRAY' ? 'string' : 'number',
-              })
-            return acc
-          },
-          [],
-        )
+    // recent games come as pages newest first, only the first is read here and
+    // older ones when the grid asks for them
+    const [file, ...pages]: string[] =
+      view === 'recent_games' && manifest['gamesetting_games.pages']
+        ? manifest['gamesetting_games.pages']
+        : [manifest[_file] ?? _file]
 
-        rowData.value = parquetData.map((row: any) =>
-          row.reduce((acc: any, value: any, index: number) => {
-            if (columns[index]) acc[columns[index].name] = value
-            return acc
-          }, {}),
-        )
+    const { rows, columns } = await readFile(file, view, filter)
+    if (fetchGeneration !== generation) return
+    rowData.value = rows
+    colDefs.value = columnsToColDefs(columns, view, ai, filter)
+    olderPages = pages
+  } catch (error) {
+    console.error('Fetch or read error:', error)
+  }
+}
 
-        colDefs.value = columnsToColDefs(columns, view, ai, filter)
-      },
-    })
+// appends the next older recent games page, one at a time
+export const fetchOlderPage = async (params: FetchParams) => {
+  const { view, filter, rowData = {} } = params
+  if (loadingOlderPage || olderPages.length === 0) return
+  const fetchGeneration = generation
+  loadingOlderPage = true
+  try {
+    const { rows } = await readFile(olderPages[0], view, filter)
+    if (fetchGeneration !== generation) return
+    olderPages = olderPages.slice(1)
+    rowData.value = [...rowData.value, ...rows]
   } catch (error) {
     console.error('Fetch or read error:', error)
+  } finally {
+    loadingOlderPage = false
   }
 }
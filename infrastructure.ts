@@ -3,6 +3,7 @@ import {
   App,
   Duration,
   RemovalPolicy,
+  Size,
   Stack,
   StackProps,
   aws_cloudwatch,
@@ -80,9 +81,14 @@ export class RaptorStatsStack extends Stack {
       environment: {
         DISCORD_USERNAME: process.env.DISCORD_USERNAME,
         DATA_BUCKET: dataBucket.bucketName,
+        // one process per AI, their merges then run serially
+        PROCESS_MAP_WORKERS: '3',
       },
       timeout: Duration.seconds(900),
-      memorySize: 2500,
+      // room to run the following stages in process
+      memorySize: 3000,
+      // memory mapped uncompressed Arrow copies of the games, about 1.4KB a game
+      ephemeralStorageSize: Size.gibibytes(4),
       architecture: aws_lambda.Architecture.ARM_64,
       retryAttempts: 0,
       maxEventAge: Duration.minutes(5),
@@ -95,7 +101,7 @@ export class RaptorStatsStack extends Stack {
     )
     dataBucket.grantReadWrite(raptorStats)
     dataBucketDev.grantReadWrite(raptorStats)
-    fileServeBucket.grantWrite(raptorStats)
+    fileServeBucket.grantReadWrite(raptorStats)
     eventRuleRaptorStats.addTarget(
       new aws_events_targets.LambdaFunction(raptorStats),
     )
@@ -113,7 +119,7 @@ export class RaptorStatsStack extends Stack {
     pveRating.grantInvoke(raptorStats)
     dataBucket.grantReadWrite(pveRating)
     dataBucketDev.grantReadWrite(pveRating)
-    fileServeBucket.grantWrite(pveRating)
+    fileServeBucket.grantReadWrite(pveRating)
 
     const recentGames = new aws_lambda.DockerImageFunction(
       this,
@@ -130,8 +136,9 @@ export class RaptorStatsStack extends Stack {
     )
 
     recentGames.grantInvoke(pveRating)
-    dataBucket.grantRead(recentGames)
-    dataBucketDev.grantRead(recentGames)
+    recentGames.grantInvoke(raptorStats)
+    dataBucket.grantReadWrite(recentGames)
+    dataBucketDev.grantReadWrite(recentGames)
     fileServeBucket.grantReadWrite(recentGames)
 
     const exceptionTopic = new aws_sns.Topic(this, 'lambda-exception-topic', {
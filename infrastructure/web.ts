@@ -28,9 +28,9 @@ export class WebStack extends Stack {
     )
     bucket.addCorsRule({
       allowedHeaders: ['*'],
-      allowedMethods: [aws_s3.HttpMethods.GET],
+      allowedMethods: [aws_s3.HttpMethods.GET, aws_s3.HttpMethods.HEAD],
       allowedOrigins: ['*'],
-      exposedHeaders: [],
+      exposedHeaders: ['Content-Length', 'Content-Range'],
       maxAge: 3000,
     })
 
@@ -39,7 +39,8 @@ export class WebStack extends Stack {
       'FileServeCachePolicy',
       {
         defaultTtl: Duration.hours(3),
-        maxTtl: Duration.hours(3),
+        // content hashed files send an immutable Cache-Control of a year
+        maxTtl: Duration.days(365),
       },
     )
 
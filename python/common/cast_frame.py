@@ -1,10 +1,12 @@
 import datetime
+import hashlib
 import os
 import random
 
-import numpy as np
 import polars as pl
+from common.common import s3_download_df, stage_frames
 from common.gamesettings import (
+    ai_gamesetting_columns,
     nuttyb_hp_multiplier,
     possible_tweak_columns,
 )
@@ -205,6 +207,12 @@ nuttyb_hp_df = pl.DataFrame(
 
 map_replace_regex_string = r'(?i)[_\s]+[v\d\.]+\w*$'
 
+prefix_filters = {
+    'Barbarian': 'barbarian' & ~pl.col('raptors') & ~pl.col('scavengers'),
+    'Raptors': 'raptors' & ~pl.col('scavengers') & ~pl.col('barbarian'),
+    'Scavengers': 'scavengers' & ~pl.col('raptors') & ~pl.col('barbarian'),
+}
+
 
 def reorder_column(df: pl.DataFrame, new_position: int, col_name: str):
     if col_name not in df.columns:
@@ -262,19 +270,15 @@ def awards(row):
                 pass
 
     try:
-        damage_award = np.uint32(
+        damage_award = int(
             ids_names[row['awards']['fightingUnitsDestroyed'][0]['teamId']]
         )
-        damage_award_value = np.uint32(
-            row['awards']['fightingUnitsDestroyed'][0]['value']
-        )
+        damage_award_value = int(row['awards']['fightingUnitsDestroyed'][0]['value'])
     except Exception:
         pass
 
     try:
-        eco_award = np.uint32(
-            ids_names[row['awards']['mostResourcesProduced']['teamId']]
-        )
+        eco_award = int(ids_names[row['awards']['mostResourcesProduced']['teamId']])
     except Exception:
         pass
 
@@ -286,6 +290,52 @@ def awards(row):
     }
 
 
+def fingerprint_hash(canonical):
+    return int.from_bytes(
+        hashlib.blake2b(canonical.encode(), digest_size=8).digest(), 'little'
+    )
+
+
+def setting_fingerprint(df):
+    # stable 64 bit hash of the map and the settings compared for the game's AI.
+    # Null settings are left out so new columns keep old fingerprints, and only
+    # distinct settings are hashed
+    fingerprint = pl.Series('setting_fingerprint', [None] * len(df), dtype=pl.UInt64)
+    df = df.with_row_index('_row')
+    for prefix, ai_filter in prefix_filters.items():
+        _, equal_columns, lower_harder, higher_harder = ai_gamesetting_columns(prefix)
+        columns = sorted(
+            (equal_columns | lower_harder | higher_harder | {'Map Name'})
+            & set(df.columns)
+        )
+        games = (
+            df.filter(ai_filter)
+            .select('_row', *columns)
+            .with_columns(pl.struct(columns).rank('dense').alias('_setting'))
+        )
+        settings = games.unique('_setting').select(
+            '_setting',
+            pl.concat_str(
+                [
+                    pl.lit(prefix),
+                    *[
+                        pl.format(f'{x}={{}}', pl.col(x).cast(pl.String))
+                        for x in columns
+                    ],
+                ],
+                separator='\x1f',
+                ignore_nulls=True,
+            )
+            .map_elements(fingerprint_hash, return_dtype=pl.UInt64)
+            .alias('setting_fingerprint'),
+        )
+        games = games.select('_row', '_setting').join(
+            settings, on='_setting', how='left'
+        )
+        fingerprint = fingerprint.scatter(games['_row'], games['setting_fingerprint'])
+    return fingerprint
+
+
 def add_computed_cols(df):
     logger.info('Filtering games by AllyTeamsList info')
     df = df.filter(
@@ -488,6 +538,7 @@ def add_computed_cols(df):
                 .drop_nulls()
             ),
         )
+        df = df.with_columns(setting_fingerprint(df))
     return df
 
 
@@ -527,6 +578,7 @@ def cast_frame(df):
             'scav_difficulty',
             'scavengers_win',
             'scavengers',
+            'setting_fingerprint',
             'startTime',
             'supported_ais',
             'winners',
@@ -585,7 +637,7 @@ def cast_frame(df):
                 )  # multiplier was inverted https://github.com/beyond-all-reason/Beyond-All-Reason/pull/3107/files
                 .then(pl.col(col).fill_null(1.0))
                 .otherwise(1 / pl.col(col).fill_null(1.0))
-                .replace(np.inf, 1.0)
+                .replace(float('inf'), 1.0)
             )
 
     difficulty_enum = pl.Enum(
@@ -668,3 +720,22 @@ def cast_frame(df):
     )
 
     return df
+
+
+def stage_cast_games(bucket, key):
+    games = stage_frames.get((bucket, key, 'cast'))
+    if games is not None:
+        logger.info(f'Read {len(games)} cast games from the previous stage {key}')
+    return games
+
+
+def load_cast_games(bucket, key):
+    # cast once per pipeline run, a following stage in this process gets the
+    # cast games and the raw ones are let go
+    games = stage_cast_games(bucket, key)
+    if games is None:
+        games = add_computed_cols(cast_frame(s3_download_df(bucket, key)))
+        if (bucket, key) in stage_frames:
+            stage_frames[(bucket, key)] = None
+            stage_frames[(bucket, key, 'cast')] = games
+    return games
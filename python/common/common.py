@@ -1,4 +1,8 @@
+import contextlib
+import functools
+import hashlib
 import importlib
+import io
 import os
 import re
 import tempfile
@@ -6,7 +10,6 @@ import time
 import warnings
 from pathlib import Path
 
-import boto3
 import orjson
 import polars as pl
 from common.logger import get_logger
@@ -27,6 +30,16 @@ FILE_SERVE_BUCKET = os.environ.get('FILE_SERVE_BUCKET', 'pve-rating-web-file-ser
 LOCAL_DATA_DIR = os.environ.get(
     'LOCAL_DATA_DIR', os.path.join(Path(os.getcwd()).parent, 'var')
 )
+manifest_file_name = 'manifest.json'
+# when each file left the manifest, kept apart from the manifest readers fetch
+superseded_file_name = 'manifest.superseded.json'
+# files dropped from the manifest are kept this long for readers of an older one
+superseded_grace_seconds = int(os.environ.get('SUPERSEDED_GRACE_SECONDS', 86400))
+# frames of declared stage inputs by (bucket, key), kept for a next stage
+# running in this process
+stage_frames = {}
+# bytes moved to and from the buckets or the local data dir, for stage metrics
+s3_bytes = {'read': 0, 'written': 0}
 
 
 def interpolate(value, in_min, in_max, out_min, out_max):
@@ -54,6 +67,8 @@ def invoke_lambda(function_name: str, payload: dict = {}):
 
     else:
         logger.info(f'Invoking {function_name} {payload.get('sheet_name', '')}')
+        import boto3
+
         boto3.client('lambda').invoke(
             FunctionName=function_name,
             InvocationType='Event',
@@ -61,32 +76,69 @@ def invoke_lambda(function_name: str, payload: dict = {}):
         )
 
 
-def s3_upload_df(df, bucket, key):
+@functools.cache
+def s3_client():
+    import boto3
+
+    return boto3.client('s3')
+
+
+def write_parquet(df, file, row_groups=None, metadata=None):
+    if row_groups is None:
+        df.write_parquet(file)
+        return
+
+    import pyarrow.parquet as pq
+
+    # take the schema polars itself writes so enums and such read back unchanged
+    with io.BytesIO() as schema_file:
+        df.head(0).write_parquet(schema_file)
+        schema_file.seek(0)
+        schema = pq.read_schema(schema_file)
+    schema = schema.with_metadata({**(schema.metadata or {}), **(metadata or {})})
+    table = df.to_arrow().cast(schema)
+    # one row group per given length so readers can fetch a slice without the rest
+    with pq.ParquetWriter(file, schema, compression='zstd') as writer:
+        offset = 0
+        for length in row_groups:
+            if length > 0:
+                writer.write_table(table.slice(offset, length), row_group_size=length)
+            offset += length
+
+
+def s3_upload_df(df, bucket, key, row_groups=None, metadata=None):
+    if (bucket, key) in stage_frames:
+        stage_frames[(bucket, key)] = df
+
     if not bucket:
         key = os.path.join(LOCAL_DATA_DIR, key)
         Path(os.path.dirname(key)).mkdir(parents=True, exist_ok=True)
         logger.info(f'Writing {len(df)} locally to {key}')
-        df.write_parquet(key)
+        write_parquet(df, key, row_groups, metadata)
+        s3_bytes['written'] += os.path.getsize(key)
         return
 
+    from botocore.exceptions import EndpointConnectionError
+
     logger.info(f'Uploading {len(df)} to s3://{bucket}/{key}')
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=UserWarning)
         with tempfile.SpooledTemporaryFile() as tmp_file:
-            df.write_parquet(tmp_file)
+            write_parquet(df, tmp_file, row_groups, metadata)
+            s3_bytes['written'] += tmp_file.tell()
             tmp_file.seek(0)
             try:
-                boto3.client('s3').upload_fileobj(
+                s3_client().upload_fileobj(
                     tmp_file,
                     bucket,
                     key,
                     ExtraArgs={'StorageClass': 'INTELLIGENT_TIERING'},
                 )
-            except boto3.botocore.exceptions.EndpointConnectionError:
+            except EndpointConnectionError:
                 logger.error('failed to connect. Retrying.')
                 time.sleep(4)
                 tmp_file.seek(0)
-                boto3.client('s3').upload_fileobj(
+                s3_client().upload_fileobj(
                     tmp_file,
                     bucket,
                     key,
@@ -94,10 +146,169 @@ def s3_upload_df(df, bucket, key):
                 )
 
 
+def s3_upload_bytes(body, bucket, key, **extra_args):
+    s3_bytes['written'] += len(body)
+    if not bucket:
+        key = os.path.join(LOCAL_DATA_DIR, key)
+        Path(os.path.dirname(key)).mkdir(parents=True, exist_ok=True)
+        logger.info(f'Writing {len(body)} bytes locally to {key}')
+        with open(key, 'wb') as f:
+            f.write(body)
+        return
+
+    logger.info(f'Uploading {len(body)} bytes to s3://{bucket}/{key}')
+    s3_client().put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        StorageClass='INTELLIGENT_TIERING',
+        **extra_args,
+    )
+
+
+def s3_publish_df(df, bucket, key, row_groups=None, metadata=None, manifest=None):
+    # content addressed so the file never changes and can be cached forever
+    with io.BytesIO() as buffer:
+        write_parquet(df, buffer, row_groups, metadata)
+        body = buffer.getvalue()
+    stem, extension = os.path.splitext(key)
+    digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+    if manifest is not None and manifest.get(key) == f'{stem}.{digest}{extension}':
+        logger.info(f'Unchanged {key}, keeping {manifest[key]}')
+        return {key: manifest[key]}
+
+    s3_upload_bytes(
+        body,
+        bucket,
+        f'{stem}.{digest}{extension}',
+        CacheControl='public, max-age=31536000, immutable',
+    )
+    return {key: f'{stem}.{digest}{extension}'}
+
+
+def s3_download_bytes(bucket, key):
+    if not bucket:
+        with open(os.path.join(LOCAL_DATA_DIR, key), 'rb') as f:
+            body = f.read()
+    else:
+        body = s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    s3_bytes['read'] += len(body)
+    return body
+
+
+def load_json(bucket, key):
+    from botocore.exceptions import ClientError
+
+    # a manifest or its bookkeeping that fails to load must not be replaced,
+    # superseded files would never be deleted
+    try:
+        return orjson.loads(s3_download_bytes(bucket, key))
+    except FileNotFoundError:
+        pass
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in {'NoSuchKey', '404'}:
+            raise
+    logger.info(f'No previous {key}')
+    return {}
+
+
+def load_manifest(bucket):
+    return load_json(bucket, manifest_file_name)
+
+
+def manifest_files(manifest):
+    return {
+        file
+        for value in manifest.values()
+        for file in (value if isinstance(value, list) else [value])
+    }
+
+
+def s3_delete_keys(bucket, keys):
+    if not bucket:
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(LOCAL_DATA_DIR, key))
+        return
+
+    for start in range(0, len(keys), 1000):
+        s3_client().delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[start : start + 1000]]},
+        )
+
+
+def publish_manifest(bucket, published, replace=()):
+    # written last, readers switch to the new files all at once. Keys starting
+    # with one of replace are owned by the publishing stage, those it no longer
+    # publishes leave the manifest and their files are superseded
+    previous = load_manifest(bucket)
+    manifest = {
+        **{
+            key: value
+            for key, value in previous.items()
+            if not key.startswith(replace)
+        },
+        **published,
+    }
+
+    # content hashed files are deleted a grace period after they left the manifest
+    files = manifest_files(manifest)
+    now = int(time.time())
+    superseded = {
+        file: since
+        for file, since in {
+            **dict.fromkeys(manifest_files(previous) - files, now),
+            **load_json(WRITE_DATA_BUCKET, superseded_file_name),
+        }.items()
+        if file not in files
+    }
+    expired = sorted(
+        file
+        for file, since in superseded.items()
+        if now - since >= superseded_grace_seconds
+    )
+
+    s3_upload_bytes(
+        orjson.dumps(manifest, option=orjson.OPT_SORT_KEYS),
+        bucket,
+        manifest_file_name,
+        ContentType='application/json',
+        CacheControl='max-age=60',
+    )
+    # after the manifest, a failed run may leak files but never deletes early
+    s3_upload_bytes(
+        orjson.dumps(
+            {file: since for file, since in superseded.items() if file not in expired},
+            option=orjson.OPT_SORT_KEYS,
+        ),
+        WRITE_DATA_BUCKET,
+        superseded_file_name,
+        ContentType='application/json',
+    )
+    if expired:
+        logger.info(f'Deleting {len(expired)} superseded files')
+        s3_delete_keys(bucket, expired)
+    return manifest
+
+
 def s3_download_df(bucket, key):
+    df = stage_frames.get((bucket, key))
+    if df is not None:
+        logger.info(f'Read {len(df)} from the previous stage {key}')
+        return df
+
+    df = s3_fetch_df(bucket, key)
+    if (bucket, key) in stage_frames:
+        stage_frames[(bucket, key)] = df
+    return df
+
+
+def s3_fetch_df(bucket, key):
     if not bucket:
         key = os.path.join(LOCAL_DATA_DIR, key)
         df = pl.read_parquet(key)
+        s3_bytes['read'] += os.path.getsize(key)
         logger.info(f'Read {len(df)} locally from {key}')
         return df
 
@@ -111,11 +322,12 @@ def s3_download_df(bucket, key):
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=UserWarning)
             with tempfile.SpooledTemporaryFile() as tmp_file:
-                boto3.client('s3').download_fileobj(
+                s3_client().download_fileobj(
                     bucket,
                     key,
                     tmp_file,
                 )
+                s3_bytes['read'] += tmp_file.tell()
                 tmp_file.seek(0)
                 df = pl.read_parquet(tmp_file)
     except Exception as e:
@@ -126,27 +338,17 @@ def s3_download_df(bucket, key):
     return df
 
 
-def user_ids_name_map(games):
-    logger.info('Making user id->player name mapping')
-    cols = (
-        games.sort('startTime', descending=False)
-        .select(
-            pl.col('AllyTeams')
-            .list.eval(
-                pl.element()
-                .struct['Players']
-                .list.eval(
-                    pl.struct(
-                        pl.element().struct['userId'].cast(pl.UInt32),
-                        pl.element().struct['name'],
-                    )
-                )
-                .flatten()
-                .drop_nulls()
-            )
-            .explode()
-        )
-        .unnest('AllyTeams')
-        .to_dict()
-    )
-    return {k: v for (k, v) in zip(cols['userId'], cols['name'])}
+def s3_download_df_if_exists(bucket, key):
+    from botocore.exceptions import ClientError
+
+    # only a missing key means no previous state, other failures must not lead
+    # to recomputing and overwriting it
+    try:
+        return s3_download_df(bucket, key)
+    except FileNotFoundError:
+        pass
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in {'NoSuchKey', '404'}:
+            raise
+    logger.info(f'No previous {key}')
+    return None
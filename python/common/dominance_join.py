@@ -0,0 +1,404 @@
+import functools
+import hashlib
+import os
+import tempfile
+
+import polars as pl
+from common.logger import get_logger
+from common.parallel import process_map, worker_budget
+
+logger = get_logger()
+
+merge_workers = int(os.environ.get('MERGE_WORKERS', os.cpu_count() or 1))
+merge_parallel_min_groups = int(os.environ.get('MERGE_PARALLEL_MIN_GROUPS', 5000))
+merge_state_version = 5
+merge_chunk_pairs = int(os.environ.get('MERGE_CHUNK_PAIRS', 50_000_000))
+
+# (column, value disabling the feature, column name part, kept lower harder column)
+conditional_columns = [
+    ('evocom', 0, 'evocom', 'evocom'),
+    (
+        'commanderbuildersenabled',
+        'disabled',
+        'commanderbuilders',
+        'commanderbuildersenabled',
+    ),
+    ('assistdronesenabled', 'disabled', 'assistdrones', 'assistdronesenabled'),
+]
+extension_columns = [
+    '_merged_win_replays',
+    '_merged_loss_replays',
+    '_winners',
+    '_players',
+]
+
+
+def signature_class(games):
+    # bit per disabled conditional feature plus a bit for null nuttyb_hp
+    flags = [
+        (
+            pl.col(column).eq(value).fill_null(False)
+            if column in games.columns
+            else pl.lit(False)
+        )
+        for column, value, _, _ in conditional_columns
+    ] + [
+        pl.col('nuttyb_hp').is_null() if 'nuttyb_hp' in games.columns else pl.lit(False)
+    ]
+    return pl.sum_horizontal(
+        [flag.cast(pl.UInt8) * 2**bit for bit, flag in enumerate(flags)]
+    ).cast(pl.UInt8)
+
+
+@functools.lru_cache
+def comparison_plan(class_id, equal_columns, higher_harder, lower_harder):
+    for bit, (_, _, name_part, kept_column) in enumerate(conditional_columns):
+        if not class_id >> bit & 1:
+            continue
+        equal_columns = {x for x in equal_columns if name_part not in x}
+        higher_harder = {x for x in higher_harder if name_part not in x}
+        lower_harder = {
+            x for x in lower_harder if name_part not in x or x == kept_column
+        }
+    nuttyb_hp_null = bool(class_id >> len(conditional_columns) & 1)
+    if nuttyb_hp_null:
+        higher_harder = higher_harder - {'nuttyb_hp'}
+
+    # wins extend easier-or-equal games, losses extend harder-or-equal games
+    predicates = [
+        pl.when('_win')
+        .then(pl.col(f'{x}_target').le(pl.col(x)))
+        .otherwise(pl.col(f'{x}_target').ge(pl.col(x)))
+        for x in sorted(higher_harder)
+    ] + [
+        pl.when('_win')
+        .then(pl.col(f'{x}_target').ge(pl.col(x)))
+        .otherwise(pl.col(f'{x}_target').le(pl.col(x)))
+        for x in sorted(lower_harder)
+    ]
+    return (
+        sorted(equal_columns | {'Map Name'}),
+        sorted(higher_harder | lower_harder),
+        predicates,
+        nuttyb_hp_null,
+    )
+
+
+def dominance_pairs(sources, targets, ordered_columns, predicates):
+    return (
+        sources.select('_partition', '_row', '_win', *ordered_columns)
+        .join(
+            targets.select('_partition', '_row', *ordered_columns),
+            on='_partition',
+            how='inner',
+            suffix='_target',
+        )
+        .filter(*predicates)
+        .select(
+            pl.col('_row').alias('_source'),
+            pl.col('_row_target').alias('_target'),
+            '_win',
+        )
+    )
+
+
+def merge_pairs(groups, equal_columns, higher_harder, lower_harder):
+    # groups are distinct settings, every group dominates itself so games with
+    # equal settings extend each other. Dominance is transitive within a class,
+    # the pairs are therefore already the closure of the group DAG
+    has_nuttyb_hp = 'nuttyb_hp' in groups.columns
+    pairs = []
+    for class_id in (
+        groups.filter(pl.col('_has_win') | pl.col('_has_loss'))['_class']
+        .unique()
+        .sort()
+    ):
+        partition_columns, ordered_columns, predicates, nuttyb_hp_null = (
+            comparison_plan(
+                class_id,
+                frozenset(equal_columns),
+                frozenset(higher_harder),
+                frozenset(lower_harder),
+            )
+        )
+        # sources have no null settings, so they are always among the targets
+        targets = groups.filter(
+            pl.all_horizontal(pl.col(partition_columns).is_not_null()),
+            pl.col('nuttyb_hp').is_null() if has_nuttyb_hp and nuttyb_hp_null else True,
+        ).with_columns(pl.struct(partition_columns).rank('dense').alias('_partition'))
+        sources = pl.concat(
+            [
+                targets.filter('_has_win').with_columns(pl.lit(True).alias('_win')),
+                targets.filter('_has_loss').with_columns(pl.lit(False).alias('_win')),
+            ]
+        ).filter(pl.col('_class').eq(class_id))
+        logger.debug(
+            f'Dominance join {len(sources)} groups class {class_id} on {len(partition_columns)} columns'
+        )
+        pairs.append(dominance_pairs(sources, targets, ordered_columns, predicates))
+    return pl.concat(
+        pairs
+        or [
+            pl.DataFrame(
+                schema={'_source': pl.UInt32, '_target': pl.UInt32, '_win': pl.Boolean}
+            )
+        ]
+    )
+
+
+def merge_unit_pairs(path, units, equal_columns, higher_harder, lower_harder):
+    groups = pl.read_ipc(path, memory_map=True).filter(pl.col('_unit').is_in(units))
+    return merge_pairs(groups, equal_columns, higher_harder, lower_harder)
+
+
+def unit_tasks(groups, n_tasks):
+    # greedy balancing of the quadratic per unit join cost over the tasks
+    tasks = [[] for _ in range(n_tasks)]
+    costs = [0] * n_tasks
+    for unit, n_groups in (
+        groups.group_by('_unit').len().sort('len', descending=True).iter_rows()
+    ):
+        task_index = costs.index(min(costs))
+        tasks[task_index].append(unit)
+        costs[task_index] += n_groups**2
+    return [units for units in tasks if units]
+
+
+def merge_unit_columns(equal_columns):
+    # every comparison class joins on a superset of these columns, so pairs
+    # never cross units and units can be merged independently
+    return sorted(
+        {
+            x
+            for x in equal_columns
+            if not any(name_part in x for _, _, name_part, _ in conditional_columns)
+        }
+        | {'Map Name'}
+    )
+
+
+def merge_chunks(games, equal_columns):
+    # units never share pairs, batches of whole units bound the memory of the
+    # merge and the extended games by their quadratic size
+    units = games.select(
+        pl.struct(merge_unit_columns(equal_columns)).rank('dense').alias('_unit')
+    )
+    chunks = (
+        units.group_by('_unit', maintain_order=True)
+        .len()
+        .select(
+            '_unit',
+            (pl.col('len').cast(pl.UInt64).pow(2).cum_sum() // merge_chunk_pairs)
+            .cast(pl.UInt32)
+            .alias('_chunk'),
+        )
+    )
+    return units.join(chunks, on='_unit', how='left')['_chunk']
+
+
+def merge_state_plan(ai_win_column, equal_columns, higher_harder, lower_harder):
+    return hashlib.sha1(
+        str(
+            [
+                merge_state_version,
+                ai_win_column,
+                sorted(equal_columns),
+                sorted(higher_harder),
+                sorted(lower_harder),
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+def unit_signatures(games):
+    return (
+        games.group_by('_unit_hash', maintain_order=True)
+        .agg(pl.col('_row_hash'))
+        .select('_unit_hash', pl.col('_row_hash').hash().alias('_unit_signature'))
+    )
+
+
+def parallel_merge_pairs(groups, equal_columns, higher_harder, lower_harder):
+    groups = groups.with_columns(
+        pl.struct(merge_unit_columns(equal_columns)).rank('dense').alias('_unit')
+    )
+    # inside a worker only its share of the process budget is left
+    workers = min(merge_workers, worker_budget())
+    tasks = unit_tasks(groups, workers)
+    if len(groups) < merge_parallel_min_groups or len(tasks) <= 1:
+        return merge_pairs(groups, equal_columns, higher_harder, lower_harder)
+
+    # memory mapped arrow buffers shared by the workers, /dev/shm is not available in Lambda
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'groups.arrow')
+        groups.select(
+            '_row',
+            '_unit',
+            '_has_win',
+            '_has_loss',
+            '_class',
+            *sorted(
+                equal_columns
+                | higher_harder
+                | lower_harder
+                | ({'Map Name', 'nuttyb_hp'} & set(groups.columns))
+            ),
+        ).write_ipc(path, compression='uncompressed')
+        logger.info(f'Merging {len(groups)} groups in {len(tasks)} partition sets')
+        return pl.concat(
+            process_map(
+                merge_unit_pairs,
+                [
+                    (path, units, equal_columns, higher_harder, lower_harder)
+                    for units in tasks
+                ],
+                max_workers=workers,
+            )
+        )
+
+
+def merge_dominated_games(
+    games, ai_win_column, equal_columns, higher_harder, lower_harder, state=None
+):
+    not_null_compare_merge_columns = (
+        equal_columns | lower_harder | higher_harder | {ai_win_column, 'Map Name'}
+    ) - {'nuttyb_hp'}
+
+    games = games.with_row_index('_row').with_columns(
+        pl.col(ai_win_column).eq(False).alias('_win'),
+        pl.all_horizontal(
+            pl.col(sorted(not_null_compare_merge_columns)).is_not_null()
+        ).alias('_source'),
+        signature_class(games).alias('_class'),
+    )
+    logger.info(f'Skipping {games["_source"].not_().sum()} games with null settings')
+
+    plan = merge_state_plan(ai_win_column, equal_columns, higher_harder, lower_harder)
+    group_columns = sorted(
+        (
+            {'_class', 'Map Name', 'nuttyb_hp'}
+            | equal_columns
+            | higher_harder
+            | lower_harder
+        )
+        & set(games.columns)
+    )
+    row_columns = sorted({'id', '_win', '_source', *group_columns})
+    games = games.with_columns(
+        pl.struct(merge_unit_columns(equal_columns)).hash().alias('_unit_hash'),
+        # the class and nuttyb hp are not part of the Barbarian fingerprint
+        pl.struct(
+            'setting_fingerprint',
+            *sorted({'_class', 'nuttyb_hp'} & set(group_columns)),
+        )
+        .hash()
+        .alias('_group_hash'),
+        pl.struct(
+            pl.struct(row_columns).hash(),
+            pl.col('winners').hash(),
+            pl.col('players').hash(),
+        )
+        .hash()
+        .alias('_row_hash'),
+    )
+
+    # units with the same games in the same order as last run keep their merge results
+    reused_units = []
+    if state is not None and len(state) > 0 and state['_plan'][0] == plan:
+        reused_units = unit_signatures(games).join(
+            state.select('_unit_hash', '_unit_signature'),
+            on=['_unit_hash', '_unit_signature'],
+            how='semi',
+        )['_unit_hash']
+    changed = games.filter(~pl.col('_unit_hash').is_in(reused_units))
+
+    # the dominance join runs on distinct settings instead of games
+    groups = (
+        changed.group_by('_group_hash', maintain_order=True)
+        .agg(
+            pl.col(group_columns).first(),
+            (pl.col('_source') & pl.col('_win')).any().alias('_has_win'),
+            (pl.col('_source') & ~pl.col('_win')).any().alias('_has_loss'),
+        )
+        .with_row_index('_row')
+    )
+    logger.info(
+        f'Merging {len(changed)} games in {len(groups)} setting groups, reusing merge state of {len(games) - len(changed)} games in {len(reused_units)} partitions'
+    )
+
+    pairs = parallel_merge_pairs(groups, equal_columns, higher_harder, lower_harder)
+
+    group_hashes = groups.select('_row', '_group_hash')
+    merged = (
+        pairs.join(group_hashes.rename({'_row': '_source'}), on='_source', how='inner')
+        .join(
+            games.filter('_source').select(
+                '_group_hash', '_win', '_row', 'id', 'winners', 'players'
+            ),
+            on=['_group_hash', '_win'],
+            how='inner',
+        )
+        .sort('_target', '_row')
+        .group_by('_target', maintain_order=True)
+        .agg(
+            pl.col('id').filter('_win').alias('_merged_win_replays'),
+            pl.col('id').filter(~pl.col('_win')).alias('_merged_loss_replays'),
+            pl.col('winners')
+            .filter('_win')
+            .flatten()
+            .unique(maintain_order=True)
+            .alias('_winners'),
+            pl.col('players').flatten().unique(maintain_order=True).alias('_players'),
+        )
+        .join(group_hashes.rename({'_row': '_target'}), on='_target', how='inner')
+        .drop('_target')
+    )
+    if len(reused_units) > 0:
+        merged = pl.concat(
+            [
+                merged,
+                state.filter(pl.col('_unit_hash').is_in(reused_units)).select(
+                    *extension_columns, '_group_hash'
+                ),
+            ],
+            how='vertical_relaxed',
+        )
+    logger.info(f'Merging into {len(merged)} setting groups')
+
+    def extend(column, extension, dtype):
+        return pl.col(column).list.concat(
+            pl.col(extension).fill_null(pl.lit([], dtype=pl.List(dtype)))
+        )
+
+    # player id sets stay duplicate free, keeping first occurrence order. The
+    # extensions of a group include its own games, duplicates of the own
+    # replays are removed when grouping the gamesettings
+    def extend_set(column, extension):
+        return extend(column, extension, pl.UInt32).list.unique(maintain_order=True)
+
+    state = (
+        games.select('_unit_hash', '_group_hash')
+        .unique(maintain_order=True)
+        .join(unit_signatures(games), on='_unit_hash', how='left')
+        .join(merged, on='_group_hash', how='left')
+        .with_columns(pl.lit(plan).alias('_plan'))
+    )
+    games = games.join(merged, on='_group_hash', how='left').sort('_row')
+    return (
+        games.with_columns(
+            extend('Merged Win Replays', '_merged_win_replays', pl.String),
+            extend('Merged Loss Replays', '_merged_loss_replays', pl.String),
+            winners_extended=extend_set('winners_extended', '_winners'),
+            players_extended=extend_set('players_extended', '_players'),
+        ).drop(
+            '_row',
+            '_win',
+            '_source',
+            '_unit_hash',
+            '_group_hash',
+            '_row_hash',
+            '_class',
+            *extension_columns,
+        ),
+        state,
+    )
@@ -450,3 +450,29 @@ barbarian_gamesetting_equal_columns = {
     'unit_restrictions_notech2',
     'unit_restrictions_notech3',
 }
+
+
+def ai_gamesetting_columns(prefix):
+    # (ai win column, equal columns, lower harder columns, higher harder columns)
+    if prefix == 'Barbarian':
+        return (
+            'barbarian_win',
+            barbarian_gamesetting_equal_columns | set(possible_tweak_columns),
+            {'comrespawn', 'disable_fogofwar'},
+            {'Barbarian Per Player', 'Barbarian Handicap'},
+        )
+    if prefix == 'Raptors':
+        return (
+            'raptors_win',
+            {x for x in gamesetting_equal_columns if 'scav_' not in x},
+            {x for x in lower_harder if 'scav_' not in x},
+            {x for x in higher_harder if 'scav_' not in x},
+        )
+    if prefix == 'Scavengers':
+        return (
+            'scavengers_win',
+            {x for x in gamesetting_equal_columns if 'raptor_' not in x},
+            {x for x in lower_harder if 'raptor_' not in x},
+            {x for x in higher_harder if 'raptor_' not in x},
+        )
+    raise ValueError(f'Unknown AI prefix {prefix}')
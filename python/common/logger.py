@@ -22,10 +22,16 @@ def lambda_handler_decorator(func):
         )
         logger = get_logger(os.environ['LAMBDA_NAME'])
 
+        from common.metrics import stage_metrics
+        from common.pipeline import start_stage_frames
+
+        start_stage_frames(context)
+
         os.environ['details_fetch_limit'] = event.get('details_fetch_limit', '500')
         logger.debug('event: %s', event)
         try:
-            result = func(event, context)
+            with stage_metrics(os.environ['LAMBDA_NAME']):
+                result = func(event, context)
         except Exception as e:
             logger.exception(e)
             raise e
@@ -0,0 +1,103 @@
+import contextlib
+import os
+import resource
+import sys
+import time
+
+import orjson
+import psutil
+from common.common import LOCAL_DATA_DIR, s3_bytes
+from common.logger import get_logger
+
+logger = get_logger()
+
+metrics_namespace = 'RaptorStats'
+metrics_file_name = os.environ.get(
+    'METRICS_FILE', os.path.join(LOCAL_DATA_DIR, 'metrics.jsonl')
+)
+# same names as scripts/benchmark.py measure() where they overlap
+metric_units = {
+    'wall_s': 'Seconds',
+    'cpu_s': 'Seconds',
+    'rss_delta_mb': 'Megabytes',
+    'max_rss_mb': 'Megabytes',
+    'rows_in': 'Count',
+    'rows_out': 'Count',
+    's3_read_bytes': 'Bytes',
+    's3_written_bytes': 'Bytes',
+}
+
+
+def cpu_seconds():
+    # children are counted once they are joined, as process_map does
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in [
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        ]
+    )
+
+
+def emit_metrics(record):
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        # embedded metric format, CloudWatch extracts the metrics from the log
+        sys.stdout.write(
+            orjson.dumps(
+                {
+                    '_aws': {
+                        'Timestamp': record['timestamp'],
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': metrics_namespace,
+                                'Dimensions': [['function', 'stage']],
+                                'Metrics': [
+                                    {'Name': name, 'Unit': unit}
+                                    for name, unit in metric_units.items()
+                                    if name in record
+                                ],
+                            }
+                        ],
+                    },
+                    **record,
+                }
+            ).decode()
+            + '\n'
+        )
+        sys.stdout.flush()
+        return
+
+    with open(metrics_file_name, 'ab') as f:
+        f.write(orjson.dumps(record) + b'\n')
+
+
+@contextlib.contextmanager
+def stage_metrics(stage):
+    process = psutil.Process(os.getpid())
+    rss_before = process.memory_info().rss
+    cpu_before = cpu_seconds()
+    s3_bytes_before = dict(s3_bytes)
+    start = time.perf_counter()
+    stats = {}
+    try:
+        yield stats
+    finally:
+        record = {
+            'timestamp': int(time.time() * 1000),
+            'function': os.environ.get('LAMBDA_NAME', ''),
+            'stage': stage,
+            'wall_s': round(time.perf_counter() - start, 3),
+            'cpu_s': round(cpu_seconds() - cpu_before, 3),
+            'rss_delta_mb': round((process.memory_info().rss - rss_before) / 2**20, 1),
+            'max_rss_mb': round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1
+            ),
+            's3_read_bytes': s3_bytes['read'] - s3_bytes_before['read'],
+            's3_written_bytes': s3_bytes['written'] - s3_bytes_before['written'],
+            **stats,
+        }
+        logger.info(f'{stage} {record}')
+        try:
+            emit_metrics(record)
+        except Exception as e:
+            logger.warning(f'Failed writing {stage} metrics {e}')
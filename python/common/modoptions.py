@@ -1,7 +1,13 @@
+import functools
 import os
+
 import orjson
 
-with open(
-    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modoptions.json'), 'r'
-) as f:
-    modoptions = orjson.loads(f.read())
+
+@functools.cache
+def load_modoptions():
+    with open(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modoptions.json'),
+        'rb',
+    ) as f:
+        return orjson.loads(f.read())
@@ -0,0 +1,77 @@
+import contextlib
+import multiprocessing
+import os
+import traceback
+
+import psutil
+from common.logger import get_logger
+
+logger = get_logger()
+
+
+def worker_budget():
+    # processes a process_map here may run at once, nested calls share it
+    return int(os.environ.get('PROCESS_MAP_WORKERS', os.cpu_count() or 1))
+
+
+def process_tree_rss(process):
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        with contextlib.suppress(psutil.Error):
+            rss += child.memory_info().rss
+    return rss
+
+
+def _worker(func, tasks, connection, budget):
+    os.environ['PROCESS_MAP_WORKERS'] = str(budget)
+    try:
+        connection.send((None, [func(*task) for task in tasks]))
+    except Exception:
+        connection.send((traceback.format_exc(), None))
+    finally:
+        connection.close()
+
+
+def process_map(func, tasks, max_workers=None):
+    # Process + Pipe instead of multiprocessing.Pool since Lambda has no /dev/shm
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks), worker_budget())
+    if max_workers <= 1:
+        return [func(*task) for task in tasks]
+
+    # each worker gets an equal share of the budget for its own process_map, a
+    # share of one runs it serially
+    budget = max(1, worker_budget() // max_workers)
+
+    logger.info(f'Running {len(tasks)} tasks in {max_workers} processes')
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for worker_index in range(max_workers):
+        worker_tasks = list(range(worker_index, len(tasks), max_workers))
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_worker,
+            args=(func, [tasks[i] for i in worker_tasks], sender, budget),
+            # not daemonic so workers can run process_map themselves
+            daemon=False,
+        )
+        process.start()
+        sender.close()
+        workers.append((worker_tasks, receiver, process))
+
+    results = [None] * len(tasks)
+    errors = []
+    for worker_tasks, receiver, process in workers:
+        try:
+            error, worker_results = receiver.recv()
+        except EOFError:
+            error, worker_results = f'worker {process.pid} died', None
+        process.join()
+        if error:
+            errors.append(error)
+            continue
+        for task_index, result in zip(worker_tasks, worker_results):
+            results[task_index] = result
+
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+    return results
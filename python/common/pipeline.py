@@ -0,0 +1,106 @@
+import importlib
+import os
+from types import SimpleNamespace
+
+import psutil
+from common.common import (
+    dev,
+    invoke_lambda,
+    READ_DATA_BUCKET,
+    replay_details_file_name,
+    stage_frames,
+)
+from common.logger import get_logger
+from common.parallel import process_tree_rss
+from common.players import players_file_name
+
+logger = get_logger()
+
+# each stage declares the files it reads and writes, the inputs written by an
+# earlier stage are handed over in memory when the stages share a process,
+# memory_mb is the peak of the stage's whole process tree
+stages = {
+    'RaptorStats': {
+        'module': 'raptor_stats',
+        'inputs': [],
+        'outputs': [replay_details_file_name, players_file_name],
+        'seconds': 600,
+        'memory_mb': 1500,
+    },
+    'PveRating': {
+        'module': 'pve_rating',
+        'inputs': [
+            (READ_DATA_BUCKET, replay_details_file_name),
+            (READ_DATA_BUCKET, players_file_name),
+        ],
+        'outputs': ['manifest.json', 'pve_ratings.json'],
+        'seconds': int(os.environ.get('PVE_RATING_STAGE_SECONDS', 600)),
+        'memory_mb': int(os.environ.get('PVE_RATING_STAGE_MEMORY_MB', 2000)),
+    },
+    'RecentGames': {
+        'module': 'recent_games',
+        'inputs': [
+            (READ_DATA_BUCKET, replay_details_file_name),
+            (READ_DATA_BUCKET, players_file_name),
+        ],
+        'outputs': ['manifest.json'],
+        'seconds': int(os.environ.get('RECENT_GAMES_STAGE_SECONDS', 120)),
+        'memory_mb': int(os.environ.get('RECENT_GAMES_STAGE_MEMORY_MB', 1000)),
+    },
+}
+stage_input_keys = {key for stage in stages.values() for key in stage['inputs']}
+
+
+def start_stage_frames(context):
+    # a stage invoked on its own starts empty, a warm container keeps nothing
+    # from its previous run
+    if getattr(context, 'in_process', False):
+        return
+    stage_frames.clear()
+    stage_frames.update(dict.fromkeys(stage_input_keys))
+
+
+def stage_fits(stage, context):
+    if dev:
+        return True
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    # workers of the finished stage are joined, any still running count too
+    available_mb = (
+        int(context.memory_limit_in_mb)
+        - process_tree_rss(psutil.Process(os.getpid())) / 2**20
+    )
+    return (
+        context.get_remaining_time_in_millis() / 1000 >= stage['seconds']
+        and available_mb >= stage['memory_mb']
+    )
+
+
+def invoke_stage(function_name, payload, context):
+    stage = stages[function_name]
+    if not stage_fits(stage, context):
+        stage_frames.clear()
+        invoke_lambda(function_name, payload)
+        return
+
+    passed = [key for key, df in stage_frames.items() if df is not None]
+    logger.info(f'Running {function_name} in process, passing {passed}')
+    lambda_name = os.environ.get('LAMBDA_NAME', '')
+    try:
+        importlib.import_module(stage['module']).main(
+            payload,
+            SimpleNamespace(
+                function_name=function_name,
+                in_process=True,
+                **{
+                    attribute: getattr(context, attribute)
+                    for attribute in [
+                        'get_remaining_time_in_millis',
+                        'memory_limit_in_mb',
+                    ]
+                    if hasattr(context, attribute)
+                },
+            ),
+        )
+    finally:
+        os.environ['LAMBDA_NAME'] = lambda_name
@@ -0,0 +1,91 @@
+import polars as pl
+from common.common import READ_DATA_BUCKET, s3_download_df_if_exists
+from common.logger import get_logger
+
+logger = get_logger()
+
+players_file_name = 'players.parquet'
+players_schema = {
+    'userId': pl.UInt32,
+    'name': pl.String,
+    'first_seen': pl.Datetime('us', 'UTC'),
+    'last_seen': pl.Datetime('us', 'UTC'),
+}
+
+
+def game_players(games):
+    return (
+        games.select(
+            'startTime',
+            pl.col('AllyTeams')
+            .list.eval(
+                pl.element()
+                .struct['Players']
+                .list.eval(
+                    pl.struct(
+                        pl.element().struct['userId'].cast(pl.UInt32),
+                        pl.element().struct['name'],
+                    )
+                )
+                .flatten()
+                .drop_nulls()
+            )
+            .alias('player'),
+        )
+        .explode('player')
+        .unnest('player')
+        .drop_nulls('userId')
+    )
+
+
+def update_players(players, games):
+    seen = game_players(games).select(
+        'userId',
+        'name',
+        pl.col('startTime').alias('first_seen'),
+        pl.col('startTime').alias('last_seen'),
+    )
+    logger.info(f'Updating players with {len(seen)} players of {len(games)} games')
+    return (
+        pl.concat(
+            [players, seen] if players is not None else [seen],
+            how='vertical_relaxed',
+        )
+        .group_by('userId')
+        .agg(
+            pl.col('name').sort_by('last_seen').last(),
+            pl.col('first_seen').min(),
+            pl.col('last_seen').max(),
+        )
+        .cast(players_schema)
+        .sort('userId')
+    )
+
+
+def load_players(games):
+    players = s3_download_df_if_exists(READ_DATA_BUCKET, players_file_name)
+    if players is None:
+        players = update_players(None, games)
+    return players
+
+
+def join_player_names(df, players, column):
+    names = players.select(
+        pl.col('userId').alias(column), pl.col('name').alias('_name')
+    )
+    if not isinstance(df.schema[column], pl.List):
+        return (
+            df.join(names, on=column, how='left')
+            .with_columns(pl.col('_name').alias(column))
+            .drop('_name')
+        )
+
+    # list of user ids into a comma separated string of names
+    joined = (
+        df.select(pl.int_range(pl.len(), dtype=pl.UInt32).alias('_row'), column)
+        .explode(column)
+        .join(names, on=column, how='left')
+        .group_by('_row', maintain_order=True)
+        .agg(pl.col('_name').drop_nulls().str.join(', '))
+    )
+    return df.with_columns(joined['_name'].alias(column))
@@ -1,37 +1,43 @@
-import io
+import collections
+import functools
+import glob
+import gzip
+import hashlib
 import os
 import re
+import tempfile
+import zlib
 from types import SimpleNamespace
 
-import boto3
-import numpy as np
 import orjson
 import polars as pl
 import polars.selectors as cs
 from common.cast_frame import (
-    add_computed_cols,
-    cast_frame,
+    load_cast_games,
+    prefix_filters,
     reorder_column,
     reorder_tweaks,
 )
 from common.common import (
     FILE_SERVE_BUCKET,
-    invoke_lambda,
+    load_manifest,
+    publish_manifest,
     READ_DATA_BUCKET,
     replay_details_file_name,
-    s3_download_df,
+    s3_download_df_if_exists,
+    s3_publish_df,
+    s3_upload_bytes,
     s3_upload_df,
-    user_ids_name_map,
-)
-from common.gamesettings import (
-    gamesetting_equal_columns,
-    higher_harder,
-    lower_harder,
-    possible_tweak_columns,
-    barbarian_gamesetting_equal_columns,
+    WRITE_DATA_BUCKET,
 )
+from common.dominance_join import merge_chunks, merge_dominated_games
+from common.gamesettings import ai_gamesetting_columns
 from common.logger import get_logger, lambda_handler_decorator
-from common.modoptions import modoptions
+from common.metrics import stage_metrics
+from common.modoptions import load_modoptions
+from common.parallel import process_map
+from common.pipeline import invoke_stage
+from common.players import join_player_names, load_players
 
 logger = get_logger()
 
@@ -39,61 +45,269 @@ dev = os.environ.get('ENV', 'prod') == 'dev'
 if dev:
     from bpdb import set_trace as s  # noqa: F401
 
-s()
 # Interpolation with quadratic fit
 lobby_size_teammates_completion_fit_input = [1, 2, 5, 16]
 lobby_size_teammates_completion_fit_output = [1, 4, 11, 40]
-A = np.array([[x**2, x, 1] for x in lobby_size_teammates_completion_fit_input])
-b = np.array(lobby_size_teammates_completion_fit_output)
-(
-    lobby_size_teammates_coef_a,
-    lobby_size_teammates_coef_b,
-    lobby_size_teammates_coef_c,
-) = np.linalg.lstsq(A, b, rcond=None)[0]
+
+
+@functools.cache
+def lobby_size_teammates_coefs():
+    import numpy as np
+
+    A = np.array([[x**2, x, 1] for x in lobby_size_teammates_completion_fit_input])
+    b = np.array(lobby_size_teammates_completion_fit_output)
+    return tuple(float(coef) for coef in np.linalg.lstsq(A, b, rcond=None)[0])
+
+
+prefix_workers = int(os.environ.get('PVE_RATING_WORKERS', os.cpu_count() or 1))
+
+
+def prefix_games(games, prefix):
+    return games.filter(prefix_filters[prefix])
+
+
+def code_version():
+    # the modules and the data files under common, modoptions.json drives the
+    # Copy Paste column
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1(pl.__version__.encode())
+    for path in [__file__] + sorted(
+        path
+        for pattern in ['*.py', '*.json']
+        for path in glob.glob(os.path.join(root, 'common', pattern))
+    ):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def prefix_fingerprint(games, players):
+    # everything the prefix outputs are derived from, including player names
+    digest = hashlib.sha1(code_version().encode())
+    digest.update(
+        games.select(
+            pl.struct(
+                pl.struct(
+                    'id',
+                    'setting_fingerprint',
+                    'durationMs',
+                    'barbarian_win',
+                    'raptors_win',
+                    'scavengers_win',
+                ).hash(),
+                pl.col('damage_eco_award').hash(),
+                pl.col('winners').hash(),
+                pl.col('players').hash(),
+            ).hash()
+        )
+        .to_series()
+        .to_numpy()
+        .tobytes()
+    )
+    digest.update(
+        players.join(
+            games.select(pl.col('players').flatten().unique().alias('userId')),
+            on='userId',
+            how='semi',
+        )
+        .sort('userId')
+        .select(pl.struct('userId', 'name').hash())
+        .to_series()
+        .to_numpy()
+        .tobytes()
+    )
+    return digest.hexdigest()
+
+
+def process_prefix_games(path, players_path, prefix):
+    games = prefix_games(pl.read_ipc(path, memory_map=True), prefix)
+    players = pl.read_ipc(players_path, memory_map=True)
+
+    # unchanged inputs give the same uploads, the ratings and the published file
+    # names are reused, the names again go to the manifest in case the run that
+    # cached them failed before publishing it
+    cache_key = f'PveRating.{prefix}.cache.parquet'
+    fingerprint = prefix_fingerprint(games, players)
+    cache = s3_download_df_if_exists(READ_DATA_BUCKET, cache_key)
+    if cache is not None and len(cache) > 0 and cache['_fingerprint'][0] == fingerprint:
+        logger.info(f'Reusing {prefix} ratings, {len(games)} games unchanged')
+        return (
+            dict(zip(cache['Player'].to_list(), cache['PVE Rating'].to_list())),
+            orjson.loads(cache['_published'][0]),
+        )
+
+    with stage_metrics(f'{prefix}.process_games') as stats:
+        ratings, published = process_games(games, players, prefix)
+        stats['rows_in'] = len(games)
+        stats['rows_out'] = len(ratings)
+    s3_upload_df(
+        pl.DataFrame(
+            {'Player': list(ratings), 'PVE Rating': list(ratings.values())},
+            schema={'Player': pl.String, 'PVE Rating': pl.Float32},
+        ).with_columns(
+            pl.lit(fingerprint).alias('_fingerprint'),
+            pl.lit(orjson.dumps(published).decode()).alias('_published'),
+        ),
+        WRITE_DATA_BUCKET,
+        cache_key,
+    )
+    return ratings, published
 
 
 @lambda_handler_decorator
 def main(*args):
-    _games = add_computed_cols(
-        cast_frame(s3_download_df(READ_DATA_BUCKET, replay_details_file_name))
+    with stage_metrics('load_games') as stats:
+        _games = load_cast_games(READ_DATA_BUCKET, replay_details_file_name)
+        stats['rows_out'] = len(_games)
+
+    # prefixes are independent, each worker memory maps the games and keeps its
+    # own uploads going while the others compute
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'games.arrow')
+        players_path = os.path.join(tmp_dir, 'players.arrow')
+        load_players(_games).write_ipc(players_path, compression='uncompressed')
+        _games.write_ipc(path, compression='uncompressed')
+        del _games
+        ratings, published = zip(
+            *process_map(
+                process_prefix_games,
+                [(path, players_path, prefix) for prefix in prefix_filters],
+                max_workers=prefix_workers,
+            )
+        )
+
+    with stage_metrics('publish') as stats:
+        publish_ratings(ratings)
+        # every prefix returns its shards, cached or not, so a shard no longer
+        # published has gone empty
+        publish_manifest(
+            FILE_SERVE_BUCKET,
+            dict(collections.ChainMap(*published, publish_player_index(ratings))),
+            replace=('players/',),
+        )
+        stats['rows_in'] = sum(len(x) for x in ratings)
+
+    invoke_stage('RecentGames', {}, args[1])
+
+
+player_shard_count = int(os.environ.get('PLAYER_SHARD_COUNT', 64))
+
+
+def player_shard(column):
+    return (
+        pl.col(column)
+        .map_elements(
+            lambda name: zlib.crc32(name.encode()) % player_shard_count,
+            return_dtype=pl.UInt16,
+        )
+        .alias('_shard')
     )
 
+
+def publish_player_shards(ratings, prefix, manifest):
+    # one small file per bucket of players, a profile needs only its own shard
+    published = {}
+    for (shard,), shard_ratings in (
+        ratings.with_columns(player_shard('Player'))
+        .partition_by('_shard', as_dict=True, include_key=False)
+        .items()
+    ):
+        published |= s3_publish_df(
+            shard_ratings,
+            FILE_SERVE_BUCKET,
+            f'players/{prefix}.{shard}.parquet',
+            manifest=manifest,
+        )
+    return published
+
+
+def publish_player_index(ratings):
+    index = (
+        pl.concat(
+            [
+                pl.DataFrame(
+                    {'Player': list(prefix_ratings)}, schema={'Player': pl.String}
+                ).with_columns(pl.lit(prefix).alias('AI'))
+                for prefix, prefix_ratings in zip(prefix_filters, ratings)
+            ]
+        )
+        .group_by('Player')
+        .agg(pl.col('AI').sort().alias('AIs'))
+        .with_columns(player_shard('Player').alias('Shard'))
+        .sort('Player')
+    )
+    return s3_publish_df(
+        index,
+        FILE_SERVE_BUCKET,
+        'players.index.parquet',
+        manifest=load_manifest(FILE_SERVE_BUCKET),
+    )
+
+
+def compact_ratings(ratings):
+    # names once, each ai's ratings as an array indexed like the names
+    names = sorted(set().union(*ratings))
+    return {
+        'players': names,
+        'pve_ratings': {
+            prefix + 'AI': [
+                None
+                if prefix_ratings.get(name) is None
+                else round(prefix_ratings[name], 2)
+                for name in names
+            ]
+            for prefix, prefix_ratings in zip(prefix_filters, ratings)
+        },
+    }
+
+
+def publish_ratings(ratings):
     json_data = {
         'pve_ratings': {
-            'BarbarianAI': process_games(
-                _games.filter(
-                    'barbarian' & ~pl.col('raptors') & ~pl.col('scavengers')
-                ).head(1000),
-                'Barbarian',
-            ),
-            'RaptorsAI': process_games(
-                _games.filter('raptors' & ~pl.col('scavengers') & ~pl.col('barbarian')),
-                'Raptors',
-            ),
-            'ScavengersAI': process_games(
-                _games.filter('scavengers' & ~pl.col('raptors') & ~pl.col('barbarian')),
-                'Scavengers',
-            ),
+            prefix + 'AI': prefix_ratings
+            for prefix, prefix_ratings in zip(prefix_filters, ratings)
         }
     }
 
-    s3 = boto3.client('s3')
-
-    if FILE_SERVE_BUCKET:
-        with io.BytesIO() as buffer:
-            buffer.write(orjson.dumps(json_data))
-            buffer.seek(0)
-            s3.put_object(
-                Bucket=FILE_SERVE_BUCKET,
-                Key='pve_ratings.json',
-                Body=buffer,
-                StorageClass='INTELLIGENT_TIERING',
-            )
+    for key, body in [
+        ('pve_ratings.json', orjson.dumps(json_data)),
+        ('pve_ratings.compact.json', orjson.dumps(compact_ratings(ratings))),
+    ]:
+        s3_upload_bytes(body, FILE_SERVE_BUCKET, key, ContentType='application/json')
+        s3_upload_bytes(
+            gzip.compress(body, mtime=0),
+            FILE_SERVE_BUCKET,
+            key + '.gz',
+            ContentType='application/json',
+            ContentEncoding='gzip',
+        )
 
 
-def group_games_players(games):
-    logger.info('Basic player aggregates')
-    award_sum_expression = pl.when(pl.col('players_extended').list.len().gt(1)).then(
+player_aggregates_version = 1
+
+
+def player_partial_aggregates(games):
+    if len(games) == 0:
+        return pl.DataFrame(
+            schema={
+                'Player': pl.UInt32,
+                **dict.fromkeys(
+                    [
+                        'n_games',
+                        'n_wins',
+                        'n_award_games',
+                        'award_sum',
+                        'weighted_award_sum',
+                    ],
+                    pl.UInt32,
+                ),
+            }
+        )
+
+    award_games_expression = pl.col('Player').is_in('winners') & (
+        pl.col('players_extended').list.len().gt(1)
+    )
+    award_sum_expression = (
         pl.when(pl.col('Player').eq(pl.col('damage_award'))).then(1).otherwise(0)
         + pl.when(pl.col('Player').eq(pl.col('eco_award'))).then(1).otherwise(0)
     )
@@ -102,263 +316,118 @@ def group_games_players(games):
         games.unnest('damage_eco_award')
         .explode('players')
         .rename({'players': 'Player'})
+        .drop_nulls('Player')
         .group_by('Player')
         .agg(
-            pl.len().cast(pl.UInt16, strict=True).alias('n_games'),
-            pl.col('Player').is_in('winners').mean().alias('Win Rate'),
-            pl.when(
-                pl.col('Player').is_in('winners')
-                & pl.col('players_extended').list.len().gt(1)
-            )
+            pl.len().alias('n_games'),
+            pl.col('Player').is_in('winners').sum().alias('n_wins'),
+            award_games_expression.sum().alias('n_award_games'),
+            pl.when(award_games_expression)
             .then(award_sum_expression)
-            .otherwise(None)
-            .drop_nulls()
-            .mean()
-            .alias('Award Rate'),
-            pl.when(
-                pl.col('Player').is_in('winners')
-                & pl.col('players_extended').list.len().gt(1)
-            )
+            .sum()
+            .alias('award_sum'),
+            pl.when(award_games_expression)
             .then(award_sum_expression * (pl.col('players_extended').list.len() - 1))
-            .otherwise(None)
-            .drop_nulls()
-            .mean()
-            .fill_null(0.0)
-            .alias('Weighted Award Rate'),
-        )
-        .with_columns(
-            cs.matches(r'\sRate$').cast(pl.Float32, strict=True),
+            .sum()
+            .alias('weighted_award_sum'),
         )
+        .with_columns(pl.exclude('Player').cast(pl.UInt32))
     )
 
 
-def group_games_gamesettings(games, prefix):
-    if prefix == 'Barbarian':
-        ai_win_column = 'barbarian_win'
-        ai_gamesetting_equal_columns = barbarian_gamesetting_equal_columns | set(
-            possible_tweak_columns
+def group_games_players(games, prefix):
+    logger.info('Basic player aggregates')
+    aggregates_key = f'PveRating.{prefix}.player_aggregates.parquet'
+    aggregated_games_key = f'PveRating.{prefix}.player_aggregates_games.parquet'
+
+    # counts and sums are folded in per game, changed or removed games rebuild them
+    games = games.with_columns(
+        pl.struct(
+            pl.col('winners').hash(),
+            pl.col('players').hash(),
+            pl.col('damage_eco_award').hash(),
         )
-        ai_gamesetting_lower_harder = {
-            'comrespawn',
-            'disable_fogofwar',
-        }
-        ai_gamesetting_higher_harder = {'Barbarian Per Player', 'Barbarian Handicap'}
-        games = games.filter(
-            ~pl.col('Barbarian Per Player').is_infinite(),
-            *[pl.col(col).eq(1) for col in games.columns if 'multiplier_' in col],
+        .hash()
+        .alias('_row_hash')
+    )
+    aggregates = s3_download_df_if_exists(READ_DATA_BUCKET, aggregates_key)
+    aggregated_games = s3_download_df_if_exists(READ_DATA_BUCKET, aggregated_games_key)
+    if (
+        aggregates is None
+        or aggregated_games is None
+        or len(aggregated_games) == 0
+        or aggregated_games['_version'][0] != player_aggregates_version
+        or len(aggregated_games.join(games, on=['id', '_row_hash'], how='anti')) > 0
+    ):
+        logger.info('Rebuilding player aggregates')
+        aggregates = None
+        new_games = games
+    else:
+        new_games = games.join(aggregated_games, on='id', how='anti')
+    logger.info(f'Adding {len(new_games)} games to player aggregates')
+
+    if len(new_games) > 0 or aggregates is None:
+        aggregates = (
+            pl.concat(
+                [
+                    x
+                    for x in [aggregates, player_partial_aggregates(new_games)]
+                    if x is not None
+                ]
+            )
+            .group_by('Player')
+            .agg(pl.all().sum())
+            .with_columns(pl.exclude('Player').cast(pl.UInt32))
         )
-    elif prefix == 'Raptors':
-        ai_win_column = 'raptors_win'
-        ai_gamesetting_equal_columns = {
-            x for x in gamesetting_equal_columns if 'scav_' not in x
-        }
-        ai_gamesetting_lower_harder = {x for x in lower_harder if 'scav_' not in x}
-        ai_gamesetting_higher_harder = {x for x in higher_harder if 'scav_' not in x}
-    elif prefix == 'Scavengers':
-        ai_win_column = 'scavengers_win'
-        ai_gamesetting_equal_columns = {
-            x for x in gamesetting_equal_columns if 'raptor_' not in x
-        }
-        ai_gamesetting_lower_harder = {x for x in lower_harder if 'raptor_' not in x}
-        ai_gamesetting_higher_harder = {x for x in higher_harder if 'raptor_' not in x}
-
-    remove_cols = [
-        col
-        for col in sorted(
-            ai_gamesetting_equal_columns
-            | ai_gamesetting_lower_harder
-            | ai_gamesetting_higher_harder
+        s3_upload_df(aggregates, WRITE_DATA_BUCKET, aggregates_key)
+        s3_upload_df(
+            games.select(
+                'id', '_row_hash', pl.lit(player_aggregates_version).alias('_version')
+            ),
+            WRITE_DATA_BUCKET,
+            aggregated_games_key,
         )
-        if games[col].n_unique() == 1
-    ]
-    logger.info(f'Removing non-unique columns {remove_cols}')
-    non_unique_gamesetting_values = {
-        k: v
-        for k, v in games[remove_cols].unique().to_dicts()[0].items()
-        if not ('tweak' in k and v == '') and not ('multiplier_' in k and v == 1)
-    }
-    games = games.drop(remove_cols)
-
-    col_set = set(games.columns)
-    ai_gamesetting_equal_columns = ai_gamesetting_equal_columns & col_set
-    ai_gamesetting_lower_harder = ai_gamesetting_lower_harder & col_set
-    ai_gamesetting_higher_harder = ai_gamesetting_higher_harder & col_set
 
-    ai_gamesetting_all_columns = sorted(
-        ai_gamesetting_equal_columns
-        | ai_gamesetting_lower_harder
-        | ai_gamesetting_higher_harder
+    return aggregates.select(
+        'Player',
+        pl.col('n_games').cast(pl.UInt16, strict=True),
+        (pl.col('n_wins') / pl.col('n_games')).alias('Win Rate'),
+        pl.when(pl.col('n_award_games') > 0)
+        .then(pl.col('award_sum') / pl.col('n_award_games'))
+        .alias('Award Rate'),
+        pl.when(pl.col('n_award_games') > 0)
+        .then(pl.col('weighted_award_sum') / pl.col('n_award_games'))
+        .otherwise(0.0)
+        .alias('Weighted Award Rate'),
+    ).with_columns(
+        cs.matches(r'\sRate$').cast(pl.Float32, strict=True),
     )
 
-    n_replays = len(games)
-    logger.info(f'Processing {n_replays} {prefix} games')
 
-    null_columns_df = (
-        games[
-            [
-                x
-                for x in set(ai_gamesetting_all_columns + ['Map']) - {'nuttyb_hp'}
-                if x in games.columns
-            ]
-        ]
-        .null_count()
-        .transpose(include_header=True, header_name='setting', column_names=['value'])
-        .filter(pl.col('value') > 0)
-    )
-    if len(null_columns_df) > 0:
-        logger.warning(f'found null columns {null_columns_df}')
-
-    logger.info(
-        'Merging/extending players wins of harder games into easier games and losses of easier into harder games'
-    )
-    not_null_compare_merge_columns = (
-        ai_gamesetting_equal_columns
-        | ai_gamesetting_lower_harder
-        | ai_gamesetting_higher_harder
-        | {ai_win_column, 'Map Name'}
-    ) - {'nuttyb_hp'}
-
-    skipped = 0
-    for game in games.iter_rows(named=True):
-        if any(
-            [v is None for k, v in game.items() if k in not_null_compare_merge_columns]
-        ):
-            skipped += 1
-            logger.debug(f'Skipping null game {skipped} {game['id']}')
-            continue
-
-        win = game[ai_win_column] == False
-
-        _ai_gamesetting_equal_columns = ai_gamesetting_equal_columns
-        _ai_gamesetting_higher_harder = ai_gamesetting_higher_harder
-        _ai_gamesetting_lower_harder = ai_gamesetting_lower_harder
-
-        if game.get('evocom') == 0:
-            _ai_gamesetting_equal_columns = {
-                x for x in _ai_gamesetting_equal_columns if 'evocom' not in x
-            }
-            _ai_gamesetting_higher_harder = {
-                x for x in _ai_gamesetting_higher_harder if 'evocom' not in x
-            }
-            _ai_gamesetting_lower_harder = {
-                x
-                for x in _ai_gamesetting_lower_harder
-                if 'evocom' not in x or x == 'evocom'
-            }
-        if game.get('commanderbuildersenabled') == 'disabled':
-            _ai_gamesetting_equal_columns = {
-                x for x in _ai_gamesetting_equal_columns if 'commanderbuilders' not in x
-            }
-            _ai_gamesetting_higher_harder = {
-                x for x in _ai_gamesetting_higher_harder if 'commanderbuilders' not in x
-            }
-            _ai_gamesetting_lower_harder = {
-                x
-                for x in _ai_gamesetting_lower_harder
-                if 'commanderbuilders' not in x or x == 'commanderbuildersenabled'
-            }
-        if game.get('assistdronesenabled') == 'disabled':
-            _ai_gamesetting_equal_columns = {
-                x for x in _ai_gamesetting_equal_columns if 'assistdrones' not in x
-            }
-            _ai_gamesetting_higher_harder = {
-                x for x in _ai_gamesetting_higher_harder if 'assistdrones' not in x
-            }
-            _ai_gamesetting_lower_harder = {
-                x
-                for x in _ai_gamesetting_lower_harder
-                if 'assistdrones' not in x or x == 'assistdronesenabled'
+def aggregate_gamesettings(games, ai_win_column, ai_gamesetting_all_columns):
+    return (
+        games.cast(
+            {
+                'winners_extended': pl.List(pl.UInt32),
+                'players_extended': pl.List(pl.UInt32),
             }
-
-        if game.get('nuttyb_hp') is None:
-            _ai_gamesetting_higher_harder -= {'nuttyb_hp'}
-
-        merge_games = games.filter(
-            pl.col('id').ne(game['id']),
-            pl.col('nuttyb_hp').is_null()
-            if 'nuttyb_hp' in game and game['nuttyb_hp'] is None
-            else True,
-            *[
-                pl.col(x).eq(game[x])
-                for x in (_ai_gamesetting_equal_columns | {'Map Name'})
-            ],
-            *[
-                (pl.col(x).le(game[x]) if win else pl.col(x).ge(game[x]))
-                for x in _ai_gamesetting_higher_harder
-            ],
-            *[
-                (pl.col(x).ge(game[x]) if win else pl.col(x).le(game[x]))
-                for x in _ai_gamesetting_lower_harder
-            ],
-        )
-
-        if len(merge_games) == 0:
-            continue
-
-        games = games.update(
-            merge_games.with_columns(
-                pl.col(f'Merged {'Win' if win else 'Loss'} Replays')
-                .list.concat(pl.lit([game['id']]))
-                .alias(f'Merged {'Win' if win else 'Loss'} Replays'),
-                winners_extended=pl.col('winners_extended').list.concat(
-                    pl.lit(game['winners'] if win else [])
-                ),
-                players_extended=pl.col('players_extended').list.concat(
-                    pl.lit(game['players'])
-                ),
-            ).select(
-                'id',
-                'winners_extended',
-                'players_extended',
-                'Merged Win Replays',
-                'Merged Loss Replays',
-            ),
-            on='id',
         )
-
-    games = games.cast(
-        {'winners_extended': pl.List(pl.UInt32), 'players_extended': pl.List(pl.UInt32)}
-    )
-
-    logger.info('Grouping gamesettings')
-    group_by_columns = ['Map Name'] + list(ai_gamesetting_all_columns)
-    grouped_gamesettings = (
-        games.unnest('damage_eco_award')
-        .group_by(group_by_columns)
+        .unnest('damage_eco_award')
+        .group_by('setting_fingerprint')
         .agg(
-            (
-                1
-                - (
-                    pl.col('winners_extended').flatten().drop_nulls().n_unique()
-                    / pl.col('players_extended').flatten().drop_nulls().n_unique()
-                )
-            )
-            .cast(pl.Float32, strict=True)
-            .alias('Difficulty'),
+            pl.col(['Map Name'] + list(ai_gamesetting_all_columns)).first(),
             pl.col('winners_extended')
             .sort_by('damage_award_value', descending=True)
             .flatten()
             .drop_nulls()
             .unique(maintain_order=True)
             .alias('winners'),
-            pl.col('winners_extended')
-            .flatten()
-            .drop_nulls()
-            .n_unique()
-            .cast(pl.UInt16, strict=True)
-            .alias('#Winners'),
             pl.col('players_extended')
             .sort_by('damage_award_value', descending=True)
             .flatten()
             .drop_nulls()
             .unique(maintain_order=True)
             .alias('Players'),
-            pl.col('players_extended')
-            .flatten()
-            .drop_nulls()
-            .n_unique()
-            .cast(pl.UInt16, strict=True)
-            .alias('#Players'),
             pl.when(pl.col(ai_win_column).eq(False))
             .then(pl.col('id'))
             .sort_by('damage_award_value', descending=True)
@@ -396,6 +465,8 @@ def group_games_gamesettings(games, prefix):
             .alias('games_winners'),
         )
         .with_columns(
+            pl.col('winners').list.len().cast(pl.UInt16, strict=True).alias('#Winners'),
+            pl.col('Players').list.len().cast(pl.UInt16, strict=True).alias('#Players'),
             pl.col('Merged Win Replays')
             .list.set_difference(pl.col('Win Replays'))
             .alias('Merged Win Replays'),
@@ -403,9 +474,109 @@ def group_games_gamesettings(games, prefix):
             .list.set_difference(pl.col('Loss Replays'))
             .alias('Merged Loss Replays'),
         )
+        .with_columns(
+            (1 - pl.col('#Winners') / pl.col('#Players'))
+            .cast(pl.Float32, strict=True)
+            .alias('Difficulty'),
+        )
     )
 
-    grouped_gamesettings = reorder_tweaks(grouped_gamesettings)
+
+def group_games_gamesettings(games, prefix):
+    (
+        ai_win_column,
+        ai_gamesetting_equal_columns,
+        ai_gamesetting_lower_harder,
+        ai_gamesetting_higher_harder,
+    ) = ai_gamesetting_columns(prefix)
+    if prefix == 'Barbarian':
+        games = games.filter(
+            ~pl.col('Barbarian Per Player').is_infinite(),
+            *[pl.col(col).eq(1) for col in games.columns if 'multiplier_' in col],
+        )
+
+    remove_cols = [
+        col
+        for col in sorted(
+            ai_gamesetting_equal_columns
+            | ai_gamesetting_lower_harder
+            | ai_gamesetting_higher_harder
+        )
+        if games[col].n_unique() == 1
+    ]
+    logger.info(f'Removing non-unique columns {remove_cols}')
+    non_unique_gamesetting_values = {
+        k: v
+        for k, v in games[remove_cols].unique().to_dicts()[0].items()
+        if not ('tweak' in k and v == '') and not ('multiplier_' in k and v == 1)
+    }
+    games = games.drop(remove_cols)
+
+    col_set = set(games.columns)
+    ai_gamesetting_equal_columns = ai_gamesetting_equal_columns & col_set
+    ai_gamesetting_lower_harder = ai_gamesetting_lower_harder & col_set
+    ai_gamesetting_higher_harder = ai_gamesetting_higher_harder & col_set
+
+    ai_gamesetting_all_columns = sorted(
+        ai_gamesetting_equal_columns
+        | ai_gamesetting_lower_harder
+        | ai_gamesetting_higher_harder
+    )
+
+    n_replays = len(games)
+    logger.info(f'Processing {n_replays} {prefix} games')
+
+    null_columns_df = (
+        games[
+            [
+                x
+                for x in set(ai_gamesetting_all_columns + ['Map']) - {'nuttyb_hp'}
+                if x in games.columns
+            ]
+        ]
+        .null_count()
+        .transpose(include_header=True, header_name='setting', column_names=['value'])
+        .filter(pl.col('value') > 0)
+    )
+    if len(null_columns_df) > 0:
+        logger.warning(f'found null columns {null_columns_df}')
+
+    logger.info(
+        'Merging/extending players wins of harder games into easier games and losses of easier into harder games'
+    )
+    merge_state_key = f'PveRating.{prefix}.merge_state.parquet'
+    merge_state = s3_download_df_if_exists(READ_DATA_BUCKET, merge_state_key)
+    games = games.with_columns(merge_chunks(games, ai_gamesetting_equal_columns))
+    chunks = games['_chunk'].unique(maintain_order=True)
+    logger.info(f'Merging and grouping gamesettings in {len(chunks)} chunks')
+
+    grouped_gamesettings = []
+    merge_states = []
+    for chunk in chunks:
+        chunk_games, chunk_merge_state = merge_dominated_games(
+            games.filter(pl.col('_chunk').eq(chunk)).drop('_chunk'),
+            ai_win_column,
+            ai_gamesetting_equal_columns,
+            ai_gamesetting_higher_harder,
+            ai_gamesetting_lower_harder,
+            state=merge_state,
+        )
+        merge_states.append(chunk_merge_state)
+        grouped_gamesettings.append(
+            aggregate_gamesettings(
+                chunk_games, ai_win_column, ai_gamesetting_all_columns
+            )
+        )
+        del chunk_games
+    del games, merge_state
+    s3_upload_df(
+        pl.concat(merge_states, how='vertical_relaxed'),
+        WRITE_DATA_BUCKET,
+        merge_state_key,
+    )
+    del merge_states
+
+    grouped_gamesettings = reorder_tweaks(pl.concat(grouped_gamesettings))
     return (
         grouped_gamesettings,
         ai_gamesetting_all_columns,
@@ -413,14 +584,230 @@ def group_games_gamesettings(games, prefix):
     )
 
 
-user_ids_names = {}
+paste_skip_columns = {'nuttyb_hp', 'Barbarian Handicap', 'Barbarian Per Player'}
 
 
-def process_games(games, prefix):
-    global user_ids_names
-    user_ids_names = user_ids_name_map(games)
-    games = games.drop('AllyTeams', 'AllyTeamsList')
-    games = games.with_columns(
+def paste_command(key, value):
+    if value is not None and '_spawntimemult' in key:
+        value = round(value, 1)
+    value = str(value).strip()
+    default = load_modoptions().get(key, {}).get('def')
+    if (
+        value == ''
+        or default == value
+        or (value in {'0', '1'} and bool(int(value)) == default)
+    ):
+        return ''
+
+    value = re.sub('\\.0\\s*$', '', value)
+    if ('multiplier_' in key and value == '1') or (
+        'unit_restrictions_' in key and value == '0'
+    ):
+        return ''
+
+    if 'tweak' in key:
+        return f'!bSet {key} {value}\n'
+    value = re.sub('\\.0\\s*$', '', value)
+    return f'!{key} {value}\n'
+
+
+def paste_command_expression(df, key):
+    # few distinct values per setting, so commands are rendered once per value
+    lookup = (
+        df.select(pl.col(key).cast(pl.String).alias('key'), pl.col(key).alias('value'))
+        .unique('key', maintain_order=True)
+        .drop_nulls('key')
+    )
+    return (
+        pl.col(key)
+        .cast(pl.String)
+        .replace_strict(
+            lookup['key'],
+            [paste_command(key, value) for value in lookup['value']],
+            return_dtype=pl.String,
+        )
+        .fill_null(paste_command(key, None))
+    )
+
+
+def copy_paste_expression(
+    df, prefix, ai_gamesetting_all_columns, non_unique_gamesetting_values
+):
+    if 'nuttyb_hp' in df.columns:
+        has_nuttyb_hp = pl.col('nuttyb_hp').is_not_null()
+    else:
+        has_nuttyb_hp = pl.lit(
+            non_unique_gamesetting_values.get('nuttyb_hp') is not None
+        )
+    modded = pl.any_horizontal(
+        pl.lit(
+            any(
+                v is not None and v != ''
+                for k, v in non_unique_gamesetting_values.items()
+                if 'tweak' in k and k not in df.columns
+            )
+        ),
+        *[
+            pl.col(x).is_not_null() & pl.col(x).cast(pl.String).ne('')
+            for x in df.columns
+            if 'tweak' in x
+        ],
+    )
+
+    return pl.concat_str(
+        pl.lit('!preset coop\n!draft_mode disabled\n!unit_market 1\n!teamsize 16\n'),
+        pl.when(pl.col('Map').is_not_null() & pl.col('Map').ne(''))
+        .then(pl.lit('!map ') + pl.col('Map') + pl.lit('\n'))
+        .otherwise(pl.lit('')),
+        *[
+            paste_command_expression(df, x)
+            for x in df.columns
+            if x in ai_gamesetting_all_columns and x not in paste_skip_columns
+        ],
+        pl.lit(
+            '$welcome-message Settings from https://pverating.bar/?view=gamesettings'
+            f'&ai={prefix}&filter='
+        ),
+        pl.when(pl.col('Difficulty') == 1)
+        .then(pl.lit('unbeaten'))
+        .when(pl.col('Difficulty') == 0)
+        .then(pl.lit('easy'))
+        .otherwise(pl.lit('regular')),
+        pl.lit('&row='),
+        pl.col('index').cast(pl.String),
+        pl.when(has_nuttyb_hp)
+        .then(
+            pl.lit(
+                ' and https://docs.google.com/document/d/1ycQV-T__ilKeTKxbCyGjlTKw_6nmDSFdJo-kPmPrjIs'
+            )
+        )
+        .otherwise(pl.lit('')),
+        pl.lit('\n'),
+        pl.when(modded)
+        .then(pl.lit(f'$rename [Modded] {prefix}\n'))
+        .otherwise(pl.lit('')),
+    )
+
+
+teammates_batch_pairs = int(os.environ.get('TEAMMATES_BATCH_PAIRS', 10_000_000))
+
+
+def teammates_completions(player_games):
+    # a teammate is new in the first game of the setting the player shares with them
+    pairs = player_games.join(
+        player_games.select('_game', pl.col('Player').alias('teammate')), on='_game'
+    ).filter(pl.col('Player').ne(pl.col('teammate')))
+    new_teammates = (
+        pairs.group_by('_setting', 'Player', 'teammate')
+        .agg(pl.col('_game').min())
+        .group_by('_setting', 'Player', '_game')
+        .len('n_new_teammates')
+    )
+    del pairs
+
+    lobby_size = pl.col('lobby_size').cast(pl.Float64)
+    coef_a, coef_b, coef_c = lobby_size_teammates_coefs()
+    return (
+        player_games.join(new_teammates, on=['_setting', 'Player', '_game'], how='left')
+        .with_columns(
+            pl.when(pl.col('lobby_size').eq(1))
+            .then(1.0)
+            .otherwise(
+                pl.col('Difficulty').cast(pl.Float64)
+                / (
+                    pl.max_horizontal(
+                        1.0,
+                        coef_a * (lobby_size * lobby_size)
+                        + coef_b * lobby_size
+                        + coef_c,
+                    )
+                    / (pl.col('n_new_teammates').fill_null(0) + 1)
+                )
+            )
+            .alias('completion')
+        )
+        # additions are non-negative, so capping the running sum once is exact
+        .group_by('_setting', 'Player')
+        .agg(pl.col('completion').sort_by('_game').cum_sum().last().clip(0.0, 1.0))
+    )
+
+
+def teammates_completion_top_5(gamesettings, regular_offset, cheese_offset):
+    # one row per player in each game of a gamesetting, games in damage order
+    gamesettings = gamesettings.select(
+        'index', 'Difficulty', 'games_winners'
+    ).with_row_index('_setting')
+    player_games = (
+        gamesettings.select('_setting', 'Difficulty', 'games_winners')
+        .explode('games_winners')
+        .with_row_index('_game')
+        .with_columns(pl.col('games_winners').list.len().alias('lobby_size'))
+        .explode('games_winners')
+        .rename({'games_winners': 'Player'})
+        .drop_nulls('Player')
+    )
+
+    # teammate pairs grow with the squared lobby size, batches bound the memory
+    batches = (
+        player_games.group_by('_setting')
+        .agg((pl.col('lobby_size').cast(pl.UInt64) ** 2).sum().alias('pairs'))
+        .sort('_setting')
+        .select(
+            '_setting',
+            (pl.col('pairs').cum_sum() // teammates_batch_pairs).alias('_batch'),
+        )
+    )
+    completions = pl.concat(
+        [
+            teammates_completions(batch_games.drop('_batch'))
+            for batch_games in player_games.join(batches, on='_setting').partition_by(
+                '_batch'
+            )
+        ]
+        or [
+            pl.DataFrame(
+                schema={
+                    '_setting': pl.UInt32,
+                    'Player': pl.UInt32,
+                    'completion': pl.Float64,
+                }
+            )
+        ]
+    )
+    del player_games
+
+    difficulty = pl.col('Difficulty').cast(pl.Float64)
+    return (
+        gamesettings.drop('games_winners')
+        .join(completions, on='_setting')
+        .with_columns(
+            (
+                pl.col('index')
+                + pl.when(difficulty < 1).then(regular_offset).otherwise(0)
+                + pl.when(difficulty == 0).then(cheese_offset).otherwise(0)
+            ).alias('indices'),
+            (difficulty * pl.col('completion')).alias('diff_completions'),
+        )
+        .group_by('Player')
+        .agg(
+            pl.col('Difficulty', 'completion', 'diff_completions', 'indices')
+            .sort_by(['diff_completions', '_setting'], descending=True)
+            .head(5)
+        )
+        .select(
+            'Player',
+            pl.struct(
+                pl.col('Difficulty').cast(pl.List(pl.Float32)).alias('diffs'),
+                pl.col('completion').cast(pl.List(pl.Float32)).alias('completions'),
+                pl.col('diff_completions').cast(pl.List(pl.Float32)),
+                pl.col('indices').cast(pl.List(pl.UInt16), strict=True),
+            ).alias('Top-5 Difficulties'),
+        )
+    )
+
+
+def prepare_games(games, prefix):
+    return games.drop('AllyTeams', 'AllyTeamsList').with_columns(
         pl.lit([]).alias('Merged Win Replays'),
         pl.lit([]).alias('Merged Loss Replays'),
         winners=pl.col('winners')
@@ -433,7 +820,22 @@ def process_games(games, prefix):
         winners_extended=pl.col('winners'),
         players_extended=pl.col('players'),
     )
-    basic_player_aggregates = group_games_players(games)
+
+
+def process_games(games, players, prefix):
+    games = prepare_games(games, prefix)
+    basic_player_aggregates = group_games_players(games, prefix)
+    player_replays = (
+        join_player_names(
+            games.select('id', pl.col('players').alias('Player'))
+            .explode('Player')
+            .drop_nulls('Player'),
+            players,
+            'Player',
+        )
+        .group_by('Player')
+        .agg(pl.col('id').sort().alias('Replays'))
+    )
 
     (
         grouped_gamesettings_rating,
@@ -444,81 +846,31 @@ def process_games(games, prefix):
 
     grouped_gamesettings_rating = (
         grouped_gamesettings_rating.rename({'Map Name': 'Map', 'winners': 'Winners'})
-        .sort(by=['Difficulty', '#Players', 'Map'], descending=[True, True, False])
+        # the fingerprint breaks ties so unchanged settings keep their row index
+        .sort(
+            by=['Difficulty', '#Players', 'Map', 'setting_fingerprint'],
+            descending=[True, True, False, False],
+        )
         .with_row_index()
         .cast({'index': pl.UInt16}, strict=True)
     )
 
     logger.info('Creating pastes')
-    pastes = []
-    for row in grouped_gamesettings_rating.iter_rows(named=True):
-        row = {**non_unique_gamesetting_values, **row}
-        _str = '!preset coop\n!draft_mode disabled\n!unit_market 1\n!teamsize 16\n' + (
-            f'!map {row["Map"]}\n' if row['Map'] else ''
-        )
-
-        for key, value in row.items():
-            value = str(round(value, 1) if '_spawntimemult' in key else value).strip()
-            if (
-                key in {'nuttyb_hp', 'Barbarian Handicap', 'Barbarian Per Player'}
-                or key not in ai_gamesetting_all_columns
-                or value is None
-                or value == ''
-                or modoptions.get(key, {}).get('def') == value
-                or (
-                    value in {'0', 0, '1', 1}
-                    and bool(int(value)) == modoptions.get(key, {}).get('def')
-                )
-            ):
-                continue
-
-            value = re.sub('\\.0\\s*$', '', value)
-
-            if ('multiplier_' in key and value == '1') or (
-                'unit_restrictions_' in key and value == '0'
-            ):
-                continue
-
-            if 'tweak' in key:
-                _str += f'!bSet {key} {value}\n'
-            else:
-                _str += f'!{key} {re.sub("\\.0\\s*$", "", str(value))}\n'
-
-        nuttyb_link_str = (
-            ' and https://docs.google.com/document/d/1ycQV-T__ilKeTKxbCyGjlTKw_6nmDSFdJo-kPmPrjIs'
-            if 'nuttyb_hp' in row and row['nuttyb_hp'] is not None
-            else ''
-        )
-
-        web_filter = 'regular'
-        if row['Difficulty'] == 1:
-            web_filter = 'unbeaten'
-        elif row['Difficulty'] == 0:
-            web_filter = 'easy'
-
-        web_link = f'https://pverating.bar/?view=gamesettings&ai={prefix}&filter={web_filter}&row={row['index']}'
-        pastes.append(
-            _str
-            + f'$welcome-message Settings from {web_link}{nuttyb_link_str}\n'
-            + (
-                f'$rename [Modded] {prefix}\n'
-                if any(
-                    v is not None and v != '' for k, v in row.items() if 'tweak' in k
-                )
-                else ''
-            )
-        )
+    copy_paste = copy_paste_expression(
+        grouped_gamesettings_rating,
+        prefix,
+        ai_gamesetting_all_columns,
+        non_unique_gamesetting_values,
+    )
 
-    grouped_gamesettings_export = grouped_gamesettings_rating.with_columns(
-        pl.col('Winners')
-        .list.eval(
-            pl.element().replace_strict(user_ids_names),
-        )
-        .list.join(', '),
-        pl.col('Players')
-        .list.eval(pl.element().replace_strict(user_ids_names))
-        .list.join(', '),
-        pl.Series(pastes).alias('Copy Paste'),
+    grouped_gamesettings_export = join_player_names(
+        join_player_names(
+            grouped_gamesettings_rating.with_columns(copy_paste.alias('Copy Paste')),
+            players,
+            'Winners',
+        ),
+        players,
+        'Players',
     )[
         'index',
         'Difficulty',
@@ -533,96 +885,47 @@ def process_games(games, prefix):
         'Copy Paste',
         'Map',
         *ai_gamesetting_all_columns,
+        'setting_fingerprint',
     ]
-    del pastes
-
-    s3_upload_df(
-        grouped_gamesettings_export,
-        FILE_SERVE_BUCKET,
-        prefix + '.all.grouped_gamesettings.parquet',
-    )
-
-    if prefix == 'Scavengers':
-        invoke_lambda('RecentGames')
 
     difficulty_max = grouped_gamesettings_export['Difficulty'].max()
     difficulty_min = grouped_gamesettings_export['Difficulty'].min()
 
-    regular = grouped_gamesettings_export.filter(
-        pl.col('Difficulty').is_between(difficulty_min, difficulty_max, closed='none')
-    )
-    unbeaten = grouped_gamesettings_export.filter(
-        pl.col('Difficulty') == difficulty_max
-    )
-
-    regular_offset = -len(unbeaten)
-    cheese_offset = -len(regular)
-
-    s3_upload_df(
-        regular,
-        FILE_SERVE_BUCKET,
-        prefix + '.regular.grouped_gamesettings.parquet',
-    )
-    s3_upload_df(
-        unbeaten,
-        FILE_SERVE_BUCKET,
-        prefix + '.unbeaten.grouped_gamesettings.parquet',
+    # rows are already sorted unbeaten, regular, cheese so each tier is one slice
+    n_unbeaten = (grouped_gamesettings_export['Difficulty'] == difficulty_max).sum()
+    n_cheese = (grouped_gamesettings_export['Difficulty'] == difficulty_min).sum()
+    n_regular = (
+        grouped_gamesettings_export['Difficulty']
+        .is_between(difficulty_min, difficulty_max, closed='none')
+        .sum()
     )
-    s3_upload_df(
-        grouped_gamesettings_export.filter(pl.col('Difficulty') == difficulty_min),
+    regular_offset = -n_unbeaten
+    cheese_offset = -n_regular
+
+    tiers = {
+        'unbeaten': [0, n_unbeaten],
+        'regular': [n_unbeaten, n_unbeaten + n_regular],
+        'cheese': [
+            len(grouped_gamesettings_export) - n_cheese,
+            len(grouped_gamesettings_export),
+        ],
+    }
+    manifest = load_manifest(FILE_SERVE_BUCKET)
+    published = s3_publish_df(
+        grouped_gamesettings_export,
         FILE_SERVE_BUCKET,
-        prefix + '.cheese.grouped_gamesettings.parquet',
+        prefix + '.grouped_gamesettings.parquet',
+        manifest=manifest,
+        row_groups=[
+            n_unbeaten,
+            n_regular,
+            len(grouped_gamesettings_export) - n_unbeaten - n_regular,
+        ],
+        metadata={'tiers': orjson.dumps(tiers).decode()},
     )
 
-    logger.info('Creating diff_tiered_export_limited df')
-    diff_tiered_export_limited = pl.concat(
-        [
-            grouped_gamesettings_export.filter(pl.col('Difficulty') == 1)
-            .sort('#Players', descending=True)
-            .limit(50),
-            grouped_gamesettings_export.filter(
-                pl.col('Difficulty').is_between(0, 1, closed='none')
-            ),
-            grouped_gamesettings_export.filter(pl.col('Difficulty') == difficulty_min)
-            .sort('#Players', descending=True)
-            .limit(10),
-        ]
-    )
     del grouped_gamesettings_export
 
-    diff_tiered_export_limited = diff_tiered_export_limited.with_columns(
-        (
-            pl.lit('=hyperlink("https://bar-rts.com/replays/')
-            + pl.col('Win Replays').list.first()
-            + pl.lit('";"')
-            + pl.col('Win Replays').list.join(', ')
-            + pl.lit('")')
-        ).alias('Win Replays'),
-        (
-            pl.lit('=hyperlink("https://bar-rts.com/replays/')
-            + pl.col('Merged Win Replays').list.first()
-            + pl.lit('";"')
-            + pl.col('Merged Win Replays').list.join(', ')
-            + pl.lit('")')
-        ).alias('Merged Win Replays'),
-        (
-            pl.lit('=hyperlink("https://bar-rts.com/replays/')
-            + pl.col('Loss Replays').list.first()
-            + pl.lit('";"')
-            + pl.col('Loss Replays').list.join(', ')
-            + pl.lit('")')
-        ).alias('Loss Replays'),
-        (
-            pl.lit('=hyperlink("https://bar-rts.com/replays/')
-            + pl.col('Merged Loss Replays').list.first()
-            + pl.lit('";"')
-            + pl.col('Merged Loss Replays').list.join(', ')
-            + pl.lit('")')
-        ).alias('Merged Loss Replays'),
-    ).fill_null(' ')
-
-    del diff_tiered_export_limited, regular, unbeaten
-
     logger.info('Creating pve ratings')
 
     grouped_gamesettings_rating = grouped_gamesettings_rating.sort(
@@ -631,92 +934,20 @@ def process_games(games, prefix):
     logger.info(
         f'gamesettings team completions iteration gs {len(grouped_gamesettings_rating)} min players {grouped_gamesettings_rating["#Players"][-1]}'
     )
-    logger.info('Adding teammates weighted success rate + explode winners')
+    logger.info('Adding teammates completion float')
+    top_5_difficulties = teammates_completion_top_5(
+        grouped_gamesettings_rating, regular_offset, cheese_offset
+    )
 
+    logger.info('Explode winners')
     grouped_gamesettings_rating = (
-        grouped_gamesettings_rating.with_columns(
-            pl.struct('games_winners', 'Difficulty').alias('games_winners_diff'),
-        )
+        grouped_gamesettings_rating.select('Winners', 'Players', 'winners_flat')
         .explode('Winners')
         .rename({'Winners': 'Player'})
     )
 
-    logger.info('Adding teammates completion float')
-
-    def player_gamesettings_diff_comp_agg(x):
-        diff_completions = []
-        diff_goals = []
-        completions = []
-        indices = []
-        for player_gamesetting in x:
-            winner_name = player_gamesetting['_player']
-            gamesetting = player_gamesetting['']
-            difficulty_goal = gamesetting['Difficulty']
-
-            completion = 0.0
-            total_teammates = set()
-            for game_teammates in gamesetting['games_winners']:
-                if completion >= 1.0:
-                    break
-                game_teammates = set(game_teammates)
-                if winner_name not in game_teammates:
-                    continue
-
-                new_teammates = game_teammates - total_teammates - {winner_name}
-                total_teammates |= new_teammates
-                lobby_size = len(game_teammates)
-                n_new_teammates_and_me = len(new_teammates) + 1
-                if lobby_size == 1:
-                    teammates_completion_addition = 1.0
-                else:
-                    teammates_completion_addition = difficulty_goal / (
-                        max(
-                            1,
-                            lobby_size_teammates_coef_a * (lobby_size**2)
-                            + lobby_size_teammates_coef_b * lobby_size
-                            + lobby_size_teammates_coef_c,
-                        )
-                        / n_new_teammates_and_me
-                    )
-
-                completion = min(
-                    1.0,
-                    completion + teammates_completion_addition,
-                )
-            diff_completions.append(difficulty_goal * completion)
-            diff_goals.append(difficulty_goal)
-            completions.append(completion)
-            indices.append(
-                player_gamesetting['index']
-                + (regular_offset if difficulty_goal < 1 else 0)
-                + (cheese_offset if difficulty_goal == 0 else 0)
-            )
-
-        # Get the indices of the top k values
-        diff_completions = np.array(diff_completions)
-        k = min(5, len(diff_completions))
-        top_5_indices = np.argpartition(diff_completions, -k)[-k:]
-        top_5_indices = top_5_indices[np.argsort(diff_completions[top_5_indices])][::-1]
-
-        struct = {
-            'diffs': [np.float32(diff_goals[i]) for i in top_5_indices],
-            'completions': [np.float32(completions[i]) for i in top_5_indices],
-            'diff_completions': [
-                np.float32(diff_completions[i]) for i in top_5_indices
-            ],
-            'indices': [np.uint16(indices[i]) for i in top_5_indices],
-        }
-        return struct
-
     logger.info('Grouping by player and aggregating')
     grouped_gamesettings_rating = grouped_gamesettings_rating.group_by('Player').agg(
-        pl.struct(
-            pl.col('Player').alias('_player'),
-            pl.col('games_winners_diff').explode(),
-            pl.col('index'),
-        )
-        .map_elements(player_gamesettings_diff_comp_agg, return_dtype=pl.Struct)
-        .alias('Top-5 Difficulties'),
         pl.when(pl.col('Player').is_in('winners_flat'))
         .then(pl.col('Players').list.set_difference(pl.col('winners_flat')))
         .otherwise(pl.lit([]))
@@ -732,6 +963,9 @@ def process_games(games, prefix):
         .cast(pl.UInt16, strict=True)
         .alias('#Settings'),
     )
+    grouped_gamesettings_rating = grouped_gamesettings_rating.join(
+        top_5_difficulties, on='Player', how='left'
+    ).select('Player', 'Top-5 Difficulties', pl.exclude('Player', 'Top-5 Difficulties'))
 
     logger.info('Join basic aggregates')
     grouped_gamesettings_rating = (
@@ -792,8 +1026,10 @@ def process_games(games, prefix):
             .cast(pl.Float32, strict=True)
             .round(2)
             .alias('PVE Rating'),
-            pl.col('Player').replace_strict(user_ids_names, return_dtype=pl.String),
         )
+    )
+    grouped_gamesettings_rating = (
+        join_player_names(grouped_gamesettings_rating, players, 'Player')
         .sort(by=['PVE Rating', 'Player'], descending=[True, False], nulls_last=True)
         .fill_null('')
     )
@@ -816,10 +1052,16 @@ def process_games(games, prefix):
 
     logger.info('Updating sheets grouped_gamesettings')
 
-    s3_upload_df(
+    published |= s3_publish_df(
         grouped_gamesettings_rating,
         FILE_SERVE_BUCKET,
         f'PveRating.{prefix}_gamesettings.parquet',
+        manifest=manifest,
+    )
+    published |= publish_player_shards(
+        grouped_gamesettings_rating.join(player_replays, on='Player', how='left'),
+        prefix,
+        manifest,
     )
 
     return {
@@ -829,7 +1071,7 @@ def process_games(games, prefix):
             .to_dict(as_series=False)
             .values()
         )
-    }
+    }, published
 
 
 if __name__ == '__main__':
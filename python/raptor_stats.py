@@ -11,12 +11,15 @@ from common.common import (
     READ_DATA_BUCKET,
     WRITE_DATA_BUCKET,
     FILE_SERVE_BUCKET,
-    invoke_lambda,
     s3_download_df,
+    s3_download_df_if_exists,
     s3_upload_df,
 )
 from common.gamesettings import gamesetting_equal_columns
 from common.logger import get_logger, lambda_handler_decorator
+from common.metrics import stage_metrics
+from common.pipeline import invoke_stage
+from common.players import players_file_name, update_players
 
 logger = get_logger()
 dev = os.environ.get('ENV', 'prod') == 'dev'
@@ -202,9 +205,12 @@ def main(*args):
         logger.info(f'Fetching {len(to_fetch_ids)} of {len(unfetched)} missing games')
 
         fetched = []
-        for index, replay_id in enumerate(to_fetch_ids.iter_rows()):
-            logger.info(f'Fetching {index+1}/{len(to_fetch_ids)} {replay_id[0]}')
-            fetched.append(api_replay_detail(replay_id[0]))
+        with stage_metrics('fetch_details') as stats:
+            for index, replay_id in enumerate(to_fetch_ids.iter_rows()):
+                logger.info(f'Fetching {index+1}/{len(to_fetch_ids)} {replay_id[0]}')
+                fetched.append(api_replay_detail(replay_id[0]))
+            stats['rows_in'] = len(to_fetch_ids)
+            stats['rows_out'] = sum(x.get('fetch_success', False) for x in fetched)
 
         null_columns = [
             pl.lit(None).alias(x) for x in set(fetched[0].keys()) - set(games.columns)
@@ -255,6 +261,13 @@ def main(*args):
             on='id',
         )
 
+    players = s3_download_df_if_exists(READ_DATA_BUCKET, players_file_name)
+    players = update_players(
+        players,
+        games
+        if players is None
+        else games.filter(pl.col('id').is_in(to_fetch_ids['id'])),
+    )
     del to_fetch_ids, unfetched
 
     if not games.filter(pl.col('fetch_success') == False).is_empty():
@@ -293,10 +306,13 @@ def main(*args):
     # )
 
     # store
-    s3_upload_df(games, WRITE_DATA_BUCKET, replay_details_file_name)
-    s3_upload_df(games, FILE_SERVE_BUCKET, replay_details_file_name)
+    with stage_metrics('store') as stats:
+        s3_upload_df(games, WRITE_DATA_BUCKET, replay_details_file_name)
+        s3_upload_df(games, FILE_SERVE_BUCKET, replay_details_file_name)
+        s3_upload_df(players, WRITE_DATA_BUCKET, players_file_name)
+        stats['rows_out'] = len(games)
 
-    invoke_lambda('PveRating')
+    invoke_stage('PveRating', {}, args[1])
 
     return 'done fetching'
 
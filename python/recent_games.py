@@ -9,16 +9,23 @@ from common.cast_frame import (
     cast_frame,
     map_replace_regex_string,
     reorder_column,
+    stage_cast_games,
 )
 from common.logger import get_logger, lambda_handler_decorator
+from common.metrics import stage_metrics
 from common.common import (
     FILE_SERVE_BUCKET,
+    load_manifest,
+    publish_manifest,
     READ_DATA_BUCKET,
     replay_details_file_name,
     s3_download_df,
+    s3_download_df_if_exists,
+    s3_publish_df,
     s3_upload_df,
-    user_ids_name_map,
+    WRITE_DATA_BUCKET,
 )
+from common.players import join_player_names, load_players
 
 dev = os.environ.get('ENV', 'prod') == 'dev'
 if dev:
@@ -26,22 +33,13 @@ if dev:
 logger = get_logger()
 
 
-@lambda_handler_decorator
-def main(*args):
-    games = s3_download_df(READ_DATA_BUCKET, replay_details_file_name)
-    games = add_computed_cols(cast_frame(games))
+feed_file_name = 'RecentGames.feed.parquet'
+feed_size = int(os.environ.get('RECENT_GAMES_FEED_SIZE', 10000))
+feed_page_size = int(os.environ.get('RECENT_GAMES_PAGE_SIZE', 1000))
 
-    grouped = pl.concat(
-        [
-            s3_download_df(
-                FILE_SERVE_BUCKET, f'{prefix}.all.grouped_gamesettings.parquet'
-            )
-            for prefix in ['Barbarian', 'Raptors', 'Scavengers']
-        ],
-        how='diagonal',
-    )
 
-    gamesetting_games = (
+def feed_rows(games):
+    return (
         games.rename({'players': 'Players'})
         .with_columns(
             pl.when('raptors')
@@ -63,9 +61,6 @@ def main(*args):
             .then(pl.lit('Draw'))
             .otherwise(pl.lit('Win'))
             .alias('Result'),
-            pl.col('Players')
-            .list.eval(pl.element().replace_strict(user_ids_name_map(games)))
-            .list.join(', '),
             pl.col('Map')
             .struct.field('scriptName')
             .str.replace(
@@ -83,29 +78,136 @@ def main(*args):
             'Map',
             'Barbarian Handicap',
             'Barbarian Per Player',
+            'setting_fingerprint',
         ]
-        .join(
-            grouped.with_columns(
-                pl.col('Win Replays').list.set_union('Loss Replays').alias('id')
+    )
+
+
+def newest_feed_rows(games):
+    # only the newest games can make the feed, so only those are cast instead of
+    # the whole history, more are cast while the filters leave too few
+    games = games.sort('startTime', descending=True)
+    n = 2 * feed_size
+    while True:
+        rows = feed_rows(add_computed_cols(cast_frame(games.head(n))))
+        if len(rows) >= feed_size or n >= len(games):
+            return rows
+        n *= 4
+
+
+def update_feed(rows, state):
+    # only ids and their sequence numbers persist, the rows are rebuilt from the
+    # current games each run so refetches and cast changes reach every page
+    feed = rows.sort('startTime', descending=True).head(feed_size)
+    feed = (
+        feed.with_columns(pl.lit(None, pl.UInt64).alias('_seq'))
+        if state is None
+        else feed.join(state.select('id', '_seq'), on='id', how='left')
+    )
+    known = feed.filter(pl.col('_seq').is_not_null())
+    new = feed.filter(pl.col('_seq').is_null()).drop('_seq').sort('startTime')
+    logger.info(f'Adding {len(new)} games to the recent games feed')
+
+    # games newer than the feed get the next numbers in start time order, games
+    # arriving late share the number of the feed game nearest in time so they
+    # land on the page of their time instead of the head page
+    newest = known['startTime'].max()
+    next_seq = 0 if known.is_empty() else known['_seq'].max() + 1
+    fresh = new if newest is None else new.filter(pl.col('startTime') > newest)
+    late = new.head(0) if newest is None else new.filter(pl.col('startTime') <= newest)
+    return pl.concat(
+        [
+            known,
+            fresh.with_columns(
+                (pl.int_range(pl.len(), dtype=pl.UInt64) + next_seq).alias('_seq')
+            ),
+            late.join_asof(
+                known.select('startTime', '_seq').sort('startTime'),
+                on='startTime',
+                strategy='nearest',
+            ),
+        ]
+    ).sort('startTime', descending=True)
+
+
+@lambda_handler_decorator
+def main(*args):
+    with stage_metrics('update_feed') as stats:
+        games = stage_cast_games(READ_DATA_BUCKET, replay_details_file_name)
+        if games is None:
+            games = s3_download_df(READ_DATA_BUCKET, replay_details_file_name)
+            rows = newest_feed_rows(games)
+        else:
+            rows = feed_rows(games)
+        feed = update_feed(
+            rows, s3_download_df_if_exists(READ_DATA_BUCKET, feed_file_name)
+        )
+        s3_upload_df(feed.select('id', '_seq'), WRITE_DATA_BUCKET, feed_file_name)
+        stats['rows_in'] = len(games)
+        stats['rows_out'] = len(feed)
+
+    manifest = load_manifest(FILE_SERVE_BUCKET)
+    grouped = pl.concat(
+        [
+            s3_download_df(
+                FILE_SERVE_BUCKET,
+                manifest.get(
+                    f'{prefix}.grouped_gamesettings.parquet',
+                    f'{prefix}.grouped_gamesettings.parquet',
+                ),
             )
-            .drop('Winners', cs.matches('Replays'))
-            .explode('id'),
-            on='id',
+            for prefix in ['Barbarian', 'Raptors', 'Scavengers']
+        ],
+        how='diagonal',
+    )
+
+    gamesetting_games = (
+        join_player_names(feed, load_players(games), 'Players')
+        # the fingerprint is recomputed from the game's current settings every
+        # run, the same way PveRating keys its groups, so it finds the game's
+        # group row without exploding the replay lists
+        .join(
+            grouped.drop('Winners', cs.matches('Replays')),
+            on='setting_fingerprint',
             how='left',
-            coalesce=True,
         )
-        .drop(cs.ends_with('_right'))
-        .sort('startTime', descending=True)
+        .drop(cs.ends_with('_right'), 'setting_fingerprint')
+        # the joins need not keep the feed's order, _seq goes last so the
+        # column positions below are those of the published pages
+        .sort(['startTime', 'id'], descending=True)
+        .select(pl.exclude('_seq'), '_seq')
         .rename({'startTime': 'Start Time', 'id': 'Replay ID'})
     )
+    del games
 
     gamesetting_games = reorder_column(gamesetting_games, 11, 'Barbarian Handicap')
     gamesetting_games = reorder_column(gamesetting_games, 11, 'Barbarian Per Player')
-    s3_upload_df(
-        gamesetting_games.head(10000),
-        FILE_SERVE_BUCKET,
-        'gamesetting_games.parquet',
-    )
+
+    # pages are cut by sequence number so a run rewrites the head page and
+    # only those older pages with late games or changed rows
+    with stage_metrics('publish_pages') as stats:
+        published = {}
+        for (page,), page_games in sorted(
+            gamesetting_games.with_columns(
+                (pl.col('_seq') // feed_page_size).alias('_page')
+            )
+            .drop('_seq')
+            .partition_by('_page', as_dict=True, include_key=False, maintain_order=True)
+            .items(),
+            reverse=True,
+        ):
+            published |= s3_publish_df(
+                page_games,
+                FILE_SERVE_BUCKET,
+                f'gamesetting_games.{page}.parquet',
+                manifest=manifest,
+            )
+        publish_manifest(
+            FILE_SERVE_BUCKET,
+            {**published, 'gamesetting_games.pages': list(published.values())},
+            replace=('gamesetting_games.',),
+        )
+        stats['rows_out'] = len(gamesetting_games)
 
 
 if __name__ == '__main__':
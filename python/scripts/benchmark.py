@@ -0,0 +1,197 @@
+import argparse
+import atexit
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import orjson
+import psutil
+
+benchmark_dir = os.path.join(
+    os.environ.get('LOCAL_DATA_DIR', os.path.join(Path(os.getcwd()).parent, 'var')),
+    'benchmark',
+)
+# keep every read and write of the pipeline local and cold
+output_dir = tempfile.mkdtemp(prefix='benchmark_')
+atexit.register(shutil.rmtree, output_dir, ignore_errors=True)
+os.environ.update(
+    {
+        'READ_DATA_BUCKET': '',
+        'WRITE_DATA_BUCKET': '',
+        'FILE_SERVE_BUCKET': '',
+        'LOCAL_DATA_DIR': output_dir,
+    }
+)
+
+import polars as pl
+from common.cast_frame import add_computed_cols, cast_frame
+from common.common import s3_bytes
+from common.logger import get_logger
+from common.parallel import process_tree_rss
+from common.players import load_players
+from pve_rating import (
+    group_games_gamesettings,
+    group_games_players,
+    prefix_filters,
+    prefix_games,
+    prepare_games,
+    process_games,
+)
+from scripts.synthetic_games import synthetic_games
+
+logger = get_logger()
+
+baseline_file_name = os.path.join(benchmark_dir, 'baseline.json')
+latest_file_name = os.path.join(benchmark_dir, 'latest.json')
+
+
+@contextlib.contextmanager
+def measure(results, stage):
+    process = psutil.Process()
+    rss_before = process_tree_rss(process)
+    peak_rss = [rss_before]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(process))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    tracemalloc.start()
+    cpu_before = process.cpu_times()
+    s3_bytes_before = dict(s3_bytes)
+    start = time.perf_counter()
+    stats = {}
+    try:
+        yield stats
+    finally:
+        wall = time.perf_counter() - start
+        cpu_after = process.cpu_times()
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        done.set()
+        sampler.join()
+        peak_rss[0] = max(peak_rss[0], process_tree_rss(process))
+        results[stage] = {
+            'wall_s': round(wall, 3),
+            'cpu_s': round(
+                cpu_after.user + cpu_after.system - cpu_before.user - cpu_before.system,
+                3,
+            ),
+            'peak_rss_mb': round(peak_rss[0] / 2**20, 1),
+            'rss_delta_mb': round((peak_rss[0] - rss_before) / 2**20, 1),
+            'python_peak_mb': round(python_peak / 2**20, 1),
+            's3_read_bytes': s3_bytes['read'] - s3_bytes_before['read'],
+            's3_written_bytes': s3_bytes['written'] - s3_bytes_before['written'],
+            **stats,
+        }
+        logger.info(f'{stage} {results[stage]}')
+
+
+def clear_state(prefix):
+    for state in ['merge_state', 'player_aggregates', 'player_aggregates_games']:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(output_dir, f'PveRating.{prefix}.{state}.parquet'))
+
+
+def synthetic_replays(n_games, seed):
+    path = os.path.join(benchmark_dir, f'synthetic_{n_games}_{seed}.parquet')
+    if not os.path.exists(path):
+        logger.info(f'Generating {n_games} synthetic games to {path}')
+        synthetic_games(n_games, seed=seed).write_parquet(path)
+    return pl.read_parquet(path)
+
+
+def benchmark(n_games, seed):
+    results = {}
+    replays = synthetic_replays(n_games, seed)
+
+    with measure(results, 'cast_frame') as stats:
+        games = add_computed_cols(cast_frame(replays))
+        stats['rows'] = len(games)
+    del replays
+
+    with measure(results, 'load_players') as stats:
+        players = load_players(games)
+        stats['rows'] = len(players)
+
+    for prefix in prefix_filters:
+        _games = prefix_games(games, prefix)
+        with measure(results, f'{prefix}.prepare_games') as stats:
+            prepared = prepare_games(_games, prefix)
+            stats['rows'] = len(prepared)
+        clear_state(prefix)
+        with measure(results, f'{prefix}.group_games_players') as stats:
+            stats['rows'] = len(group_games_players(prepared, prefix))
+
+        clear_state(prefix)
+        with measure(results, f'{prefix}.group_games_gamesettings') as stats:
+            stats['rows'] = len(group_games_gamesettings(prepared, prefix)[0])
+        del prepared
+
+        clear_state(prefix)
+        with measure(results, f'{prefix}.process_games') as stats:
+            stats['rows'] = len(process_games(_games, players, prefix)[0])
+        del _games
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            line = f'{size:>8} {stage:<36} {metrics["wall_s"]:>9.2f}s {metrics["peak_rss_mb"]:>9.0f}MB'
+            if base is None:
+                print(line + '  no baseline')
+                continue
+            wall_ratio = metrics['wall_s'] / max(base['wall_s'], 1e-3) - 1
+            rss_ratio = metrics['peak_rss_mb'] / max(base['peak_rss_mb'], 1e-3) - 1
+            flag = ''
+            # small stages are noise dominated, require an absolute change as well
+            if (
+                wall_ratio > tolerance and metrics['wall_s'] - base['wall_s'] > 0.1
+            ) or (
+                rss_ratio > tolerance
+                and metrics['peak_rss_mb'] - base['peak_rss_mb'] > 10
+            ):
+                flag = '  REGRESSION'
+                regressions.append((size, stage))
+            print(f'{line}  wall {wall_ratio:+.0%} rss {rss_ratio:+.0%}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the rating pipeline stages on synthetic games'
+    )
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    Path(benchmark_dir).mkdir(parents=True, exist_ok=True)
+    results = {size: benchmark(int(size), args.seed) for size in args.sizes.split(',')}
+    with open(latest_file_name, 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    if args.save_baseline:
+        with open(baseline_file_name, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+        logger.info(f'Saved baseline {baseline_file_name}')
+        sys.exit(0)
+
+    baseline = {}
+    if os.path.exists(baseline_file_name):
+        with open(baseline_file_name, 'rb') as f:
+            baseline = orjson.loads(f.read())
+    if compare(results, baseline, args.tolerance):
+        sys.exit(1)
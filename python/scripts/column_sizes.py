@@ -4,7 +4,6 @@ import polars as pl
 import tqdm
 
 from common.logger import get_logger
-from pve_rating import user_ids_name_map
 from common.common import LOCAL_DATA_DIR
 
 if os.environ.get('ENV', 'prod') == 'dev':
@@ -13,7 +12,6 @@ if os.environ.get('ENV', 'prod') == 'dev':
 logger = get_logger()
 
 main_df = pl.read_parquet(os.path.join(LOCAL_DATA_DIR, 'replays_gamesettings.parquet'))
-user_ids_names = user_ids_name_map(main_df)
 
 column_sizes = tqdm(
     sorted(
@@ -8,7 +8,7 @@ import polars.selectors as cs
 
 from bpdb import set_trace as s  # noqa: F401
 
-from common.common import LOCAL_DATA_DIR
+from common.common import LOCAL_DATA_DIR, load_manifest
 from common.logger import get_logger
 from common.grouped_gamesettings import (
     grouped_gamesettings_preprocessor,
@@ -26,8 +26,9 @@ def get_hnsw_index(prefix):
     logger.info(
         f'Creating {prefix} hierarchical navigable small world approximate nearest neighbor index'
     )
+    key = f'{prefix}.grouped_gamesettings.parquet'
     df = pl.read_parquet(
-        os.path.join(LOCAL_DATA_DIR, f'{prefix}.all.grouped_gamesettings.parquet')
+        os.path.join(LOCAL_DATA_DIR, load_manifest('').get(key, key))
     ).filter(pl.col('#Players') > 0)
 
     diffs = (
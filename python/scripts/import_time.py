@@ -0,0 +1,73 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from common.logger import get_logger
+from common.pipeline import stages
+
+logger = get_logger()
+
+# loaded on first use, a stage module importing them eagerly slows its cold start
+deferred_modules = ['boto3', 'botocore', 'numpy', 'pyarrow']
+
+import_time_regex = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module):
+    # a fresh interpreter per module so nothing is already imported
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, 'ENV': 'prod'},
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        match = import_time_regex.match(line)
+        if match:
+            times[match[4]] = {
+                'self_ms': int(match[1]) / 1000,
+                'cumulative_ms': int(match[2]) / 1000,
+                'depth': len(match[3]) // 2,
+            }
+    return times
+
+
+def profile(module, top):
+    times = import_times(module)
+    total_ms = times[module]['cumulative_ms']
+    print(f'{module:<16} {total_ms:>9.1f}ms')
+    for name, time in sorted(
+        ((name, time) for name, time in times.items() if time['depth'] == 1),
+        key=lambda item: item[1]['cumulative_ms'],
+        reverse=True,
+    )[:top]:
+        print(f'  {name:<36} {time["cumulative_ms"]:>9.1f}ms')
+    return total_ms, [name for name in deferred_modules if name in times]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Profile the import time of the pipeline stage modules'
+    )
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    failed = False
+    for stage in stages.values():
+        total_ms, eager = profile(stage['module'], args.top)
+        if eager:
+            logger.error(f'{stage["module"]} imports {eager} eagerly')
+            failed = True
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            logger.error(
+                f'{stage["module"]} imports in {total_ms:.1f}ms '
+                f'over the {args.budget_ms}ms budget'
+            )
+            failed = True
+    if failed:
+        sys.exit(1)
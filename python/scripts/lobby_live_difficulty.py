@@ -9,6 +9,7 @@ from bpdb import set_trace as s
 from common.cast_frame import map_replace_regex_string, reorder_column
 from common.common import (
     FILE_SERVE_BUCKET,
+    load_manifest,
     s3_download_df,
     s3_upload_df,
 )
@@ -22,6 +23,7 @@ players_file = os.path.join(bar_dir, 'users.json')
 bot_file = os.path.join(bar_dir, 'bot.txt')
 map_file = os.path.join(bar_dir, 'map.txt')
 
+manifest = load_manifest(FILE_SERVE_BUCKET)
 ratings = {}
 for prefix in [
     'Barbarian',
@@ -29,7 +31,7 @@ for prefix in [
     'Scavengers',
 ]:
     x_key = f'PveRating.{prefix}_gamesettings.parquet'
-    df = s3_download_df(FILE_SERVE_BUCKET, x_key)
+    df = s3_download_df(FILE_SERVE_BUCKET, manifest.get(x_key, x_key))
     s3_upload_df(df, '', x_key)
     ratings[prefix] = reorder_column(
         df.with_row_index().rename({'index': '#'}).drop(cs.contains('Rank')),
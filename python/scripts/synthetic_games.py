@@ -0,0 +1,251 @@
+import datetime
+import random
+
+import numpy as np
+import polars as pl
+from common.cast_frame import string_columns
+from common.gamesettings import (
+    barbarian_gamesetting_equal_columns,
+    defaults,
+    gamesetting_equal_columns,
+    gamesettings,
+    gamesettings_scav,
+    higher_harder,
+    lower_harder,
+    nuttyb_hp_multiplier,
+    possible_tweak_columns,
+)
+
+maps = [
+    'All That Glitters',
+    'Altair Crossing',
+    'Avalanche',
+    'Comet Catcher Redux',
+    'Eye of Horus',
+    'Full Metal Plate',
+    'Glacier Pass',
+    'Isthmus',
+    'Pearl Lagoon',
+    'Raptor Crater',
+    'Serene Caldera',
+    'Supreme Isthmus',
+    'Tempest',
+    'Throne',
+]
+ais = ['RaptorsAI', 'ScavengersAI', 'BARb']
+ai_weights = [6, 3, 1]
+difficulties = ['veryeasy', 'easy', 'normal', 'hard', 'veryhard', 'epic']
+
+setting_columns = sorted(
+    gamesetting_equal_columns
+    | higher_harder
+    | lower_harder
+    | barbarian_gamesetting_equal_columns
+    | set(possible_tweak_columns)
+)
+
+base_settings = {
+    **{
+        x: ('' if x in string_columns else 1 if 'multiplier_' in x else 0)
+        for x in setting_columns
+        if x not in {'nuttyb_hp', 'raptor_difficulty', 'scav_difficulty'}
+    },
+    **defaults,
+    'assistdronesenabled': 'enabled',
+    'commanderbuildersenabled': 'enabled',
+    'comrespawn': 'evocom',
+    'evocom': 1,
+    'evocomlevelcap': 10,
+    'evocomlevelupmethod': 'dynamic',
+    'evocomleveluprate': 5,
+    'evocomxpmultiplier': 1,
+    'lootboxes': 'scav_only',
+    'lootboxes_density': 'normal',
+    'raptor_difficulty': 'normal',
+    'raptor_firstwavesboost': 1,
+    'raptor_graceperiodmult': 1,
+    'raptor_queentimemult': 1,
+    'raptor_raptorstart': 'initialbox',
+    'raptor_spawncountmult': 3,
+    'raptor_spawntimemult': 1,
+    'scav_bosstimemult': 1,
+    'scav_difficulty': 'normal',
+    'scav_graceperiodmult': 1,
+    'scav_spawntimemult': 1,
+    'startenergy': 1000,
+    'startenergystorage': 1000,
+    'startmetal': 1000,
+    'startmetalstorage': 1000,
+}
+
+perturbations = {
+    'maxunits': [2000, 4000, 10000],
+    'multiplier_resourceincome': [1, 1.5, 2],
+    'raptor_spawncountmult': [1, 2, 3, 5],
+    'scav_spawntimemult': [0.5, 1, 2],
+    'startmetal': [1000, 5000, 10000],
+    'startenergy': [1000, 5000, 10000],
+    'evocom': [0, 1],
+    'assistdronesenabled': ['disabled', 'enabled'],
+    'commanderbuildersenabled': ['disabled', 'enabled'],
+}
+
+
+def synthetic_settings(rng, ai):
+    presets = list(
+        (gamesettings_scav if ai == 'ScavengersAI' else gamesettings).values()
+    )
+    settings = {**base_settings, **rng.choice(presets)}
+    for column, values in perturbations.items():
+        if rng.random() < 0.3:
+            settings[column] = rng.choice(values)
+    difficulty_column = (
+        'scav_difficulty' if ai == 'ScavengersAI' else 'raptor_difficulty'
+    )
+    settings[difficulty_column] = rng.choice(difficulties)
+    if ai == 'RaptorsAI' and rng.random() < 0.1:
+        settings['tweakdefs1'] = rng.choice(
+            rng.choice(list(nuttyb_hp_multiplier.values()))
+        )
+    return {
+        'ai': ai,
+        **{
+            column: (
+                str(value)
+                if column in string_columns
+                or column in {'raptor_difficulty', 'scav_difficulty'}
+                else value
+            )
+            for column, value in settings.items()
+        },
+    }
+
+
+def synthetic_games(n_games, seed=0, n_settings=None, n_players_pool=None):
+    # settings come from a skewed pool of distinct combinations like real lobbies,
+    # everything per game is generated column wise so 1M games stay cheap
+    n_settings = n_settings or max(50, int(n_games**0.5 * 5))
+    n_players_pool = n_players_pool or max(20, n_games // 5)
+    settings_rng = random.Random(seed)
+    settings = pl.DataFrame(
+        [
+            synthetic_settings(
+                settings_rng, settings_rng.choices(ais, weights=ai_weights)[0]
+            )
+            for _ in range(n_settings)
+        ],
+        infer_schema_length=None,
+    )
+
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, n_settings + 1)
+    games = settings[
+        rng.choice(n_settings, size=n_games, p=popularity / popularity.sum())
+    ]
+    ai = games['ai'].to_numpy()
+    lobby_sizes = np.clip(rng.exponential(4, n_games).astype(int), 1, 16)
+    n_ais = np.where(ai == 'BARb', rng.integers(1, 4, n_games), 1)
+    ai_win = rng.random(n_games) < 0.55
+    map_names = np.array(maps)[rng.integers(0, len(maps), n_games)]
+    step = max(1, 365 * 24 * 3600 // n_games)
+
+    players = (
+        pl.DataFrame(
+            {
+                'game': np.repeat(np.arange(n_games), lobby_sizes),
+                'userId': rng.integers(1, n_players_pool + 1, lobby_sizes.sum()),
+            }
+        )
+        .with_columns(
+            pl.format('Player{}', 'userId').alias('name'),
+            pl.int_range(pl.len()).over('game').alias('teamId'),
+            pl.lit(0).alias('handicap'),
+        )
+        .group_by('game', maintain_order=True)
+        .agg(pl.struct('userId', 'name', 'teamId', 'handicap').alias('Players'))
+    )
+    ai_players = (
+        pl.DataFrame(
+            {
+                'game': np.repeat(np.arange(n_games), n_ais),
+                'shortName': np.repeat(ai, n_ais),
+                'handicap': np.where(
+                    np.repeat(ai, n_ais) == 'BARb',
+                    rng.choice([0, 10, 20], n_ais.sum()),
+                    0,
+                ),
+            }
+        )
+        .group_by('game', maintain_order=True)
+        .agg(pl.struct('shortName', 'handicap').alias('AIs'))
+    )
+
+    ally_teams = pl.concat_list(
+        pl.struct(
+            pl.col('ai_win').not_().alias('winningTeam'),
+            'Players',
+            pl.col('AIs').list.slice(0, 0),
+        ),
+        pl.struct(
+            pl.col('ai_win').alias('winningTeam'),
+            pl.col('Players').list.slice(0, 0),
+            'AIs',
+        ),
+    )
+    return (
+        pl.concat(
+            [
+                games.drop('ai'),
+                players.drop('game'),
+                ai_players.drop('game'),
+                pl.DataFrame(
+                    {
+                        'ai_win': ai_win,
+                        'Map Name': map_names,
+                        'map_version': rng.integers(0, 10, n_games),
+                        'durationMs': rng.integers(60_000, 5_400_000, n_games),
+                        'damage_team': rng.integers(0, lobby_sizes),
+                        'damage': rng.integers(0, 10_000_000, n_games),
+                        'eco_team': rng.integers(0, lobby_sizes),
+                        'eco': rng.integers(0, 10_000_000, n_games),
+                    }
+                ),
+            ],
+            how='horizontal',
+        )
+        .with_columns(
+            pl.int_range(pl.len()).cast(pl.String).str.zfill(32).alias('id'),
+            (
+                pl.lit(datetime.datetime(2024, 4, 1, tzinfo=datetime.timezone.utc))
+                + pl.duration(seconds=pl.int_range(pl.len()) * step)
+            ).alias('startTime'),
+            ally_teams.alias('AllyTeams'),
+            ally_teams.alias('AllyTeamsList'),
+            pl.struct(
+                pl.concat_list(
+                    pl.struct(
+                        pl.col('damage_team').alias('teamId'),
+                        pl.col('damage').alias('value'),
+                    )
+                ).alias('fightingUnitsDestroyed'),
+                pl.struct(
+                    pl.col('eco_team').alias('teamId'), pl.col('eco').alias('value')
+                ).alias('mostResourcesProduced'),
+            ).alias('awards'),
+            pl.struct(
+                pl.format('{} v1.{}', 'Map Name', 'map_version').alias('scriptName')
+            ).alias('Map'),
+            pl.lit(False).alias('draw'),
+            pl.lit(True).alias('fetch_success'),
+        )
+        .drop(
+            'Players',
+            'AIs',
+            'ai_win',
+            'map_version',
+            'damage_team',
+            'damage',
+            'eco_team',
+            'eco',
+        )
+    )